@@ -20,7 +20,7 @@ rag = LightRAG(
 # Process files in batches of 10
 batch_size = 32
 files = sorted(os.listdir("chunks"))
-for i in tqdm(range(2240, len(files), batch_size), desc="Processing batches"):
+for i in tqdm(range(0, len(files), batch_size), desc="Processing batches"):
     batch_texts = []
     batch_files = files[i:i + batch_size]
     
@@ -31,3 +31,6 @@ for i in tqdm(range(2240, len(files), batch_size), desc="Processing batches"):
     
     rag.insert(batch_texts)
 
+# the graph is persisted as a pickled snapshot, keep the GraphML copy read by
+# 3-lightRAG2neo4J/2-export_graph.py
+rag.chunk_entity_relation_graph.export_graphml()
@@ -55,25 +55,24 @@ def batch_queries(queries: List[Dict], batch_size: int = 32):
         yield queries[i:i + batch_size]
 
 async def process_batch(rag: LightRAG, batch: List[Dict]) -> List[Dict]:
-    tasks = []
-    for item in batch:
-        query = item['Query']
-        if pd.isna(query) or str(query).strip() == '':
-            tasks.append(asyncio.create_task(asyncio.sleep(0)))
-        else:
-            tasks.append(
-                asyncio.create_task(
-                    rag.aquery(
-                        query, 
-                        param=QueryParam(
-                            mode="hybrid",
-                            max_token_for_text_unit=1024  # Limit context size
-                        )
-                    )
-                )
+    queries = [
+        item['Query'] for item in batch
+        if not (pd.isna(item['Query']) or str(item['Query']).strip() == '')
+    ]
+    # One embedding request and one matrix product per vector DB for the batch
+    answers = iter(
+        await rag.aquery_batch(
+            queries,
+            param=QueryParam(
+                mode="hybrid",
+                max_token_for_text_unit=1024  # Limit context size
             )
-    
-    results = await asyncio.gather(*tasks)
+        )
+    )
+    results = [
+        None if pd.isna(item['Query']) or str(item['Query']).strip() == '' else next(answers)
+        for item in batch
+    ]
     
     processed_batch = []
     for item, result in zip(batch, results):
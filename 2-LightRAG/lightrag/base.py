@@ -1,3 +1,4 @@
+import asyncio
 from dataclasses import dataclass, field
 from typing import TypedDict, Union, Literal, Generic, TypeVar
 
@@ -32,6 +33,18 @@ class QueryParam:
 class StorageNameSpace:
     namespace: str
     global_config: dict
+    _dirty: bool = field(default=False, init=False, repr=False)
+
+    @property
+    def is_dirty(self) -> bool:
+        """whether the storage was mutated since its last commit"""
+        return self._dirty
+
+    def mark_dirty(self):
+        self._dirty = True
+
+    def clear_dirty(self):
+        self._dirty = False
 
     async def index_done_callback(self):
         """commit the storage operations after indexing"""
@@ -50,6 +63,12 @@ class BaseVectorStorage(StorageNameSpace):
     async def query(self, query: str, top_k: int) -> list[dict]:
         raise NotImplementedError
 
+    async def query_batch(self, queries: list[str], top_k: int) -> list[list[dict]]:
+        """Search several queries at once, one result list per query.
+        Falls back to a query() per string, storages override it to vectorize.
+        """
+        return await asyncio.gather(*[self.query(q, top_k) for q in queries])
+
     async def upsert(self, data: dict[str, dict]):
         """Use 'content' field from value for embedding, use key as id.
         If embedding_func is None, use 'embedding' field from value
@@ -108,6 +127,27 @@ class BaseGraphStorage(StorageNameSpace):
     ) -> Union[list[tuple[str, str]], None]:
         raise NotImplementedError
 
+    # batch variants, one result per input in the same order; the defaults
+    # gather the single-item calls, storages override them to save round trips
+    async def get_nodes_batch(self, node_ids: list[str]) -> list[Union[dict, None]]:
+        return await asyncio.gather(*[self.get_node(n) for n in node_ids])
+
+    async def node_degrees_batch(self, node_ids: list[str]) -> list[int]:
+        return await asyncio.gather(*[self.node_degree(n) for n in node_ids])
+
+    async def get_edges_batch(
+        self, pairs: list[tuple[str, str]]
+    ) -> list[Union[dict, None]]:
+        return await asyncio.gather(*[self.get_edge(s, t) for s, t in pairs])
+
+    async def edge_degrees_batch(self, pairs: list[tuple[str, str]]) -> list[int]:
+        return await asyncio.gather(*[self.edge_degree(s, t) for s, t in pairs])
+
+    async def get_nodes_edges_batch(
+        self, node_ids: list[str]
+    ) -> list[Union[list[tuple[str, str]], None]]:
+        return await asyncio.gather(*[self.get_node_edges(n) for n in node_ids])
+
     async def upsert_node(self, node_id: str, node_data: dict[str, str]):
         raise NotImplementedError
 
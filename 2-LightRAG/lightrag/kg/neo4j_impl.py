@@ -206,6 +206,85 @@ class Neo4JStorage(BaseGraphStorage):
             return edges
 
 
+    async def _run_union_query(self, parts: List[str]) -> list:
+        """
+        Run several single-label queries in one round trip.
+
+        Node ids are labels here and labels cannot be passed as parameters, so
+        instead of UNWIND-ing a list the per-label parts are joined with
+        UNION ALL; every part returns an `idx` column naming its input.
+        """
+        if not parts:
+            return []
+        query = "\nUNION ALL\n".join(parts)
+        async with self._driver.session() as session:
+            result = await session.run(query)
+            records = [record async for record in result]
+        logger.debug(
+            f'{inspect.currentframe().f_code.co_name}:parts:{len(parts)}:records:{len(records)}'
+        )
+        return records
+
+    async def get_nodes_batch(self, node_ids: List[str]) -> List[Union[dict, None]]:
+        labels = [node_id.strip('\"') for node_id in node_ids]
+        records = await self._run_union_query([
+            f"MATCH (n:`{label}`) RETURN {i} AS idx, properties(n) AS props"
+            for i, label in enumerate(labels)
+        ])
+        nodes = [None] * len(labels)
+        for record in records:
+            if nodes[record["idx"]] is None:
+                nodes[record["idx"]] = dict(record["props"])
+        return nodes
+
+    async def node_degrees_batch(self, node_ids: List[str]) -> List[int]:
+        labels = [node_id.strip('\"') for node_id in node_ids]
+        records = await self._run_union_query([
+            f"MATCH (n:`{label}`) RETURN {i} AS idx, COUNT {{ (n)--() }} AS degree"
+            for i, label in enumerate(labels)
+        ])
+        degrees = [None] * len(labels)
+        for record in records:
+            degrees[record["idx"]] = record["degree"]
+        return degrees
+
+    async def get_edges_batch(self, pairs: List[Tuple[str, str]]) -> List[Union[dict, None]]:
+        label_pairs = [(source.strip('\"'), target.strip('\"')) for source, target in pairs]
+        records = await self._run_union_query([
+            f"MATCH (:`{source}`)-[r]->(:`{target}`) RETURN {i} AS idx, properties(r) AS props"
+            for i, (source, target) in enumerate(label_pairs)
+        ])
+        edges = [None] * len(pairs)
+        for record in records:
+            if edges[record["idx"]] is None:
+                edges[record["idx"]] = dict(record["props"])
+        return edges
+
+    async def edge_degrees_batch(self, pairs: List[Tuple[str, str]]) -> List[int]:
+        node_ids = list({node_id for pair in pairs for node_id in pair})
+        degrees = dict(zip(node_ids, await self.node_degrees_batch(node_ids)))
+        # Convert None to 0 for addition
+        return [
+            int(degrees[source] or 0) + int(degrees[target] or 0)
+            for source, target in pairs
+        ]
+
+    async def get_nodes_edges_batch(self, node_ids: List[str]) -> List[List[Tuple[str, str]]]:
+        labels = [node_id.strip('\"') for node_id in node_ids]
+        records = await self._run_union_query([
+            f"MATCH (n:`{label}`) OPTIONAL MATCH (n)-[r]-(connected) "
+            f"RETURN {i} AS idx, labels(n) AS source_labels, labels(connected) AS target_labels"
+            for i, label in enumerate(labels)
+        ])
+        edges = [[] for _ in labels]
+        for record in records:
+            source_labels = record["source_labels"]
+            target_labels = record["target_labels"]
+            if source_labels and target_labels:
+                edges[record["idx"]].append((source_labels[0], target_labels[0]))
+        return edges
+
+
     @retry(
         stop=stop_after_attempt(3),
         wait=wait_exponential(multiplier=1, min=4, max=10),
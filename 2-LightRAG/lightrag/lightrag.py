@@ -1,6 +1,8 @@
 import asyncio
+import atexit
 import os
 import importlib
+import weakref
 from dataclasses import asdict, dataclass, field
 from datetime import datetime
 from functools import partial
@@ -11,18 +13,22 @@ from .llm import (
     openai_embedding,
 )
 from .operate import (
-    chunking_by_token_size,
+    ANSWER_TIER_PREFIX,
+    chunking_documents,
     extract_entities,
     local_query,
     global_query,
     hybrid_query,
     naive_query,
+    batch_query,
 )
 
 from .storage import (
+    EmbeddingCacheStorage,
     JsonKVStorage,
     NanoVectorDBStorage,
     NetworkXStorage,
+    SemanticLLMCache,
 )
  
 from .kg.neo4j_impl import (
@@ -63,6 +69,18 @@ def always_get_an_event_loop() -> asyncio.AbstractEventLoop:
         return loop
 
 
+def _flush_at_exit(rag_ref: "weakref.ref[LightRAG]"):
+    """Run a debounced query flush still waiting on a loop that was stopped"""
+    rag = rag_ref()
+    if rag is None or rag._pending_query_flush is None:
+        return
+    loop = rag._pending_query_flush.get_loop()
+    if not rag._pending_query_flush.done() and not (
+        loop.is_running() or loop.is_closed()
+    ):
+        loop.run_until_complete(rag.aflush())
+
+
 @dataclass
 class LightRAG:
     
@@ -71,6 +89,7 @@ class LightRAG:
     )
 
     kg: str = field(default="NetworkXStorage")
+    graph_storage_cls_kwargs: dict = field(default_factory=dict)
 
     current_log_level = logger.level
     log_level: str = field(default=current_log_level)
@@ -85,6 +104,13 @@ class LightRAG:
     # entity extraction
     entity_extract_max_gleaning: int = 1
     entity_summary_to_max_tokens: int = 500
+    # pack up to this many over-long descriptions into one summary prompt
+    entity_summary_batch_size: int = 1
+    # merge extracted chunks in windows of this many (each entity summarized
+    # once per window) and persist the graph, vdbs and per-chunk extraction
+    # status after each, so an interrupted insert resumes where it stopped;
+    # 0 merges everything at the end without checkpoints
+    insert_checkpoint_interval: int = 64
 
     # node embedding
     node_embedding_algorithm: str = "node2vec"
@@ -103,19 +129,42 @@ class LightRAG:
     embedding_func: EmbeddingFunc = field(default_factory=lambda: openai_embedding)
     embedding_batch_num: int = 32
     embedding_func_max_async: int = 16
+    # optional provider quotas, in requests and prompt tokens per minute
+    embedding_func_max_rpm: int = None
+    embedding_func_max_tpm: int = None
+    # reuse vectors of already embedded strings across runs, keyed by model name
+    # (the embedding function's name when empty), dimension and text
+    enable_embedding_cache: bool = False
+    embedding_cache_model_name: str = ""
 
     # LLM
     llm_model_func: callable = gpt_4o_mini_complete  # hf_model_complete#
     llm_model_name: str = "meta-llama/Llama-3.2-1B-Instruct"  #'meta-llama/Llama-3.2-1B'#'google/gemma-2-2b-it'
     llm_model_max_token_size: int = 32768
     llm_model_max_async: int = 16
+    llm_model_max_rpm: int = None
+    llm_model_max_tpm: int = None
+    # halve the LLM concurrency on rate limits and grow it back additively
+    llm_model_adaptive_concurrency: bool = True
     llm_model_kwargs: dict = field(default_factory=dict)
 
     # storage
     key_string_value_json_storage_cls: Type[BaseKVStorage] = JsonKVStorage
+    key_string_value_json_storage_cls_kwargs: dict = field(default_factory=dict)
     vector_db_storage_cls: Type[BaseVectorStorage] = NanoVectorDBStorage
     vector_db_storage_cls_kwargs: dict = field(default_factory=dict)
     enable_llm_cache: bool = True
+    # storage of llm_response_cache, key_string_value_json_storage_cls when None;
+    # LLMResponseCacheStorage bounds it by entries, bytes and age
+    llm_response_cache_storage_cls: Type[BaseKVStorage] = None
+    llm_response_cache_storage_cls_kwargs: dict = field(default_factory=dict)
+    # answer queries similar enough to an earlier one (and reuse their
+    # extracted keywords) from a cache searched by query embedding
+    enable_semantic_llm_cache: bool = False
+    semantic_llm_cache_threshold: float = 0.95
+    semantic_llm_cache_max_entries: int = 10000
+    # coalesce the storage flushes of queries finishing within this many seconds
+    query_flush_debounce_seconds: float = 0.0
 
     # extension
     addon_params: dict = field(default_factory=dict)
@@ -147,20 +196,77 @@ class LightRAG:
         )
 
         self.llm_response_cache = (
+            (
+                self.llm_response_cache_storage_cls
+                or self.key_string_value_json_storage_cls
+            )(namespace="llm_response_cache", global_config=asdict(self))
+            if self.enable_llm_cache
+            else None
+        )
+        self.entity_summary_cache = (
             self.key_string_value_json_storage_cls(
-                namespace="llm_response_cache", global_config=asdict(self)
+                namespace="entity_summary_cache", global_config=asdict(self)
             )
             if self.enable_llm_cache
             else None
         )
-        self.chunk_entity_relation_graph = self.graph_storage_cls(
-            namespace="chunk_entity_relation", global_config=asdict(self)
+        self.chunk_extraction_status = self.key_string_value_json_storage_cls(
+            namespace="chunk_extraction_status", global_config=asdict(self)
         )
 
-        self.embedding_func = limit_async_func_call(self.embedding_func_max_async)(
-            self.embedding_func
+        self.embedding_func = limit_async_func_call(
+            self.embedding_func_max_async,
+            max_requests_per_minute=self.embedding_func_max_rpm,
+            max_tokens_per_minute=self.embedding_func_max_tpm,
+            tiktoken_model_name=self.tiktoken_model_name,
+        )(self.embedding_func)
+        self.embedding_limiter = self.embedding_func.limiter
+        self.embedding_cache = (
+            EmbeddingCacheStorage(
+                namespace="embedding_cache",
+                global_config=asdict(self),
+                embedding_func=self.embedding_func,
+                model_name=self.embedding_cache_model_name,
+            )
+            if self.enable_embedding_cache
+            else None
+        )
+        if self.embedding_cache is not None:
+            self.embedding_func = self.embedding_cache.cached_embedding_func()
+
+        self._open_graph_and_vdbs()
+
+        self.llm_model_func = limit_async_func_call(
+            self.llm_model_max_async,
+            max_requests_per_minute=self.llm_model_max_rpm,
+            max_tokens_per_minute=self.llm_model_max_tpm,
+            adaptive=self.llm_model_adaptive_concurrency,
+            tiktoken_model_name=self.tiktoken_model_name,
+        )(
+            partial(
+                self.llm_model_func,
+                hashing_kv=self.llm_response_cache,
+                **self.llm_model_kwargs,
+            )
+        )
+        self.llm_limiter = self.llm_model_func.limiter
+        self.semantic_llm_cache = (
+            SemanticLLMCache(
+                namespace="semantic_llm_cache",
+                global_config=asdict(self),
+                embedding_func=self.embedding_func,
+            )
+            if self.enable_semantic_llm_cache
+            else None
         )
+        self._pending_query_flush: asyncio.Task = None
+        if self.query_flush_debounce_seconds > 0:
+            atexit.register(_flush_at_exit, weakref.ref(self))
 
+    def _open_graph_and_vdbs(self):
+        self.chunk_entity_relation_graph = self.graph_storage_cls(
+            namespace="chunk_entity_relation", global_config=asdict(self)
+        )
         self.entities_vdb = self.vector_db_storage_cls(
             namespace="entities",
             global_config=asdict(self),
@@ -179,13 +285,13 @@ class LightRAG:
             embedding_func=self.embedding_func,
         )
 
-        self.llm_model_func = limit_async_func_call(self.llm_model_max_async)(
-            partial(
-                self.llm_model_func,
-                hashing_kv=self.llm_response_cache,
-                **self.llm_model_kwargs,
-            )
-        )
+    def limiter_stats(self) -> dict:
+        """Queue depth and wait times of the LLM and embedding call limiters"""
+        return {
+            "llm": self.llm_limiter.stats(),
+            "embedding": self.embedding_limiter.stats(),
+        }
+
     def _get_storage_class(self) -> Type[BaseGraphStorage]:
         return {
             "Neo4JStorage": Neo4JStorage,
@@ -198,6 +304,8 @@ class LightRAG:
         return loop.run_until_complete(self.ainsert(string_or_strings))
 
     async def ainsert(self, string_or_strings):
+        extracting = False
+        graph_changed = False
         try:
             if isinstance(string_or_strings, str):
                 string_or_strings = [string_or_strings]
@@ -214,20 +322,16 @@ class LightRAG:
             logger.info(f"[New Docs] inserting {len(new_docs)} docs")
 
             inserting_chunks = {}
-            for doc_key, doc in new_docs.items():
-                chunks = {
-                    compute_mdhash_id(dp["content"], prefix="chunk-"): {
-                        **dp,
-                        "full_doc_id": doc_key,
-                    }
-                    for dp in chunking_by_token_size(
-                        doc["content"],
-                        overlap_token_size=self.chunk_overlap_token_size,
-                        max_token_size=self.chunk_token_size,
-                        tiktoken_model=self.tiktoken_model_name,
-                    )
+            async for doc_key, dp in chunking_documents(
+                {doc_key: doc["content"] for doc_key, doc in new_docs.items()},
+                overlap_token_size=self.chunk_overlap_token_size,
+                max_token_size=self.chunk_token_size,
+                tiktoken_model=self.tiktoken_model_name,
+            ):
+                inserting_chunks[compute_mdhash_id(dp["content"], prefix="chunk-")] = {
+                    **dp,
+                    "full_doc_id": doc_key,
                 }
-                inserting_chunks.update(chunks)
             _add_chunk_keys = await self.text_chunks.filter_keys(
                 list(inserting_chunks.keys())
             )
@@ -239,37 +343,132 @@ class LightRAG:
                 return
             logger.info(f"[New Chunks] inserting {len(inserting_chunks)} chunks")
 
-            await self.chunks_vdb.upsert(inserting_chunks)
+            # chunks merged by an interrupted insert are already in the graph
+            # and vdbs, only their edges still waiting for an endpoint carry over
+            _pending_chunk_keys = await self.chunk_extraction_status.filter_keys(
+                list(inserting_chunks.keys())
+            )
+            done_chunk_keys = [
+                k for k in inserting_chunks if k not in _pending_chunk_keys
+            ]
+            resumed_deferred_edges = []
+            if done_chunk_keys:
+                logger.info(
+                    f"[Resume] {len(done_chunk_keys)} chunks already extracted, {len(_pending_chunk_keys)} left"
+                )
+                for status in await self.chunk_extraction_status.get_by_ids(
+                    done_chunk_keys
+                ):
+                    resumed_deferred_edges.extend(status["deferred_edges"])
+            pending_chunks = {
+                k: v for k, v in inserting_chunks.items() if k in _pending_chunk_keys
+            }
+            if len(pending_chunks):
+                await self.chunks_vdb.upsert(pending_chunks)
 
             logger.info("[Entity Extraction]...")
+            extracting = True
+            graph_changed = True
             maybe_new_kg = await extract_entities(
-                inserting_chunks,
+                pending_chunks,
                 knowledge_graph_inst=self.chunk_entity_relation_graph,
                 entity_vdb=self.entities_vdb,
                 relationships_vdb=self.relationships_vdb,
                 global_config=asdict(self),
+                checkpoint_callback=self._checkpoint_insert,
+                resumed_deferred_edges=resumed_deferred_edges,
+                summary_cache=self.entity_summary_cache,
             )
-            if maybe_new_kg is None:
+            extracting = False
+            llm_stats = self.llm_limiter.stats()
+            # tokens are only counted under a tokens-per-minute budget
+            throughput = (
+                f", {llm_stats['tokens_per_second']:.0f} tokens/s"
+                if self.llm_limiter.counts_tokens
+                else ""
+            )
+            logger.info(
+                f"[Entity Extraction] {llm_stats['completed']} LLM calls{throughput}, concurrency {llm_stats['limit']}"
+            )
+            if maybe_new_kg is None and not done_chunk_keys:
                 logger.warning("No new entities and relationships found")
                 return
-            self.chunk_entity_relation_graph = maybe_new_kg
+            if maybe_new_kg is not None:
+                self.chunk_entity_relation_graph = maybe_new_kg
 
             await self.full_docs.upsert(new_docs)
             await self.text_chunks.upsert(inserting_chunks)
         finally:
-            await self._insert_done()
+            if graph_changed and self.semantic_llm_cache is not None:
+                # checkpoints persist partial merges, even an interrupted insert
+                # leaves cached answers stale
+                self.semantic_llm_cache.clear_tiers(ANSWER_TIER_PREFIX)
+            if extracting and self.insert_checkpoint_interval:
+                # interrupted: keep the graph and vdbs at the last checkpoint, the
+                # chunks merged after it are extracted again from the llm cache
+                await self._flush_storages(
+                    [
+                        self.llm_response_cache,
+                        self.entity_summary_cache,
+                        self.embedding_cache,
+                        self.semantic_llm_cache,
+                    ]
+                )
+                await self._discard_uncheckpointed()
+            else:
+                await self._insert_done()
+
+    async def _checkpoint_insert(self, chunk_status: dict[str, dict]):
+        """Persist everything merged so far, then mark the chunks as extracted"""
+        await self._flush_storages(
+            [
+                self.llm_response_cache,
+                self.entity_summary_cache,
+                self.entities_vdb,
+                self.relationships_vdb,
+                self.chunks_vdb,
+                self.chunk_entity_relation_graph,
+                self.embedding_cache,
+            ]
+        )
+        # written last, a chunk is only skipped once its results are on disk
+        await self.chunk_extraction_status.upsert(chunk_status)
+        await self._flush_storages([self.chunk_extraction_status])
+        logger.info(f"[Checkpoint] {len(chunk_status)} more chunks extracted")
+
+    async def _discard_uncheckpointed(self):
+        """Reopen the graph and vdbs from disk, dropping what was merged after
+        the last checkpoint so a retry does not merge those chunks twice.
+        Graph storages writing straight to a database keep their writes."""
+        close = getattr(self.chunk_entity_relation_graph, "close", None)
+        if close is not None:
+            await close()
+        self._open_graph_and_vdbs()
+        logger.info(
+            "[Checkpoint] Reloaded the graph and vdbs from the last checkpoint"
+        )
 
     async def _insert_done(self):
+        await self._flush_storages(
+            [
+                self.full_docs,
+                self.text_chunks,
+                self.llm_response_cache,
+                self.entity_summary_cache,
+                self.entities_vdb,
+                self.relationships_vdb,
+                self.chunks_vdb,
+                self.chunk_entity_relation_graph,
+                self.embedding_cache,
+                self.semantic_llm_cache,
+                self.chunk_extraction_status,
+            ]
+        )
+
+    async def _flush_storages(self, storages: list[StorageNameSpace]):
+        """Storages skip the write themselves when nothing changed since the last flush"""
         tasks = []
-        for storage_inst in [
-            self.full_docs,
-            self.text_chunks,
-            self.llm_response_cache,
-            self.entities_vdb,
-            self.relationships_vdb,
-            self.chunks_vdb,
-            self.chunk_entity_relation_graph,
-        ]:
+        for storage_inst in storages:
             if storage_inst is None:
                 continue
             tasks.append(cast(StorageNameSpace, storage_inst).index_done_callback())
@@ -277,7 +476,9 @@ class LightRAG:
 
     def query(self, query: str, param: QueryParam = QueryParam()):
         loop = always_get_an_event_loop()
-        return loop.run_until_complete(self.aquery(query, param))
+        response = loop.run_until_complete(self.aquery(query, param))
+        self._flush_before_loop_stops(loop)
+        return response
 
     async def aquery(self, query: str, param: QueryParam = QueryParam()):
         if param.mode == "local":
@@ -289,6 +490,7 @@ class LightRAG:
                 self.text_chunks,
                 param,
                 asdict(self),
+                semantic_cache=self.semantic_llm_cache,
             )
         elif param.mode == "global":
             response = await global_query(
@@ -299,6 +501,7 @@ class LightRAG:
                 self.text_chunks,
                 param,
                 asdict(self),
+                semantic_cache=self.semantic_llm_cache,
             )
         elif param.mode == "hybrid":
             response = await hybrid_query(
@@ -309,6 +512,7 @@ class LightRAG:
                 self.text_chunks,
                 param,
                 asdict(self),
+                semantic_cache=self.semantic_llm_cache,
             )
         elif param.mode == "naive":
             response = await naive_query(
@@ -317,16 +521,79 @@ class LightRAG:
                 self.text_chunks,
                 param,
                 asdict(self),
+                semantic_cache=self.semantic_llm_cache,
             )
         else:
             raise ValueError(f"Unknown mode {param.mode}")
         await self._query_done()
         return response
 
+    def query_batch(self, queries: list[str], param: QueryParam = QueryParam()):
+        loop = always_get_an_event_loop()
+        responses = loop.run_until_complete(self.aquery_batch(queries, param))
+        self._flush_before_loop_stops(loop)
+        return responses
+
+    async def aquery_batch(
+        self, queries: list[str], param: QueryParam = QueryParam()
+    ) -> list[str]:
+        """Like aquery for many queries, sharing one vector search per vector DB"""
+        responses = await batch_query(
+            queries,
+            self.chunk_entity_relation_graph,
+            self.entities_vdb,
+            self.relationships_vdb,
+            self.chunks_vdb,
+            self.text_chunks,
+            param,
+            asdict(self),
+            semantic_cache=self.semantic_llm_cache,
+        )
+        await self._query_done()
+        return responses
+
     async def _query_done(self):
-        tasks = []
-        for storage_inst in [self.llm_response_cache]:
-            if storage_inst is None:
-                continue
-            tasks.append(cast(StorageNameSpace, storage_inst).index_done_callback())
-        await asyncio.gather(*tasks)
\ No newline at end of file
+        if self.query_flush_debounce_seconds <= 0:
+            await self._flush_storages(
+                [self.llm_response_cache, self.semantic_llm_cache]
+            )
+            return
+        if self._pending_query_flush is None or self._pending_query_flush.done():
+            self._pending_query_flush = asyncio.ensure_future(
+                self._debounced_query_flush()
+            )
+            self._pending_query_flush.add_done_callback(self._query_flush_finished)
+
+    async def _debounced_query_flush(self):
+        try:
+            await asyncio.sleep(self.query_flush_debounce_seconds)
+        except asyncio.CancelledError:
+            # cancelled by aflush or by a loop shutting down, flush right away
+            await self._flush_storages(
+                [self.llm_response_cache, self.semantic_llm_cache]
+            )
+            raise
+        await self._flush_storages([self.llm_response_cache, self.semantic_llm_cache])
+
+    @staticmethod
+    def _query_flush_finished(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error("Debounced query flush failed", exc_info=task.exception())
+
+    def _flush_before_loop_stops(self, loop: asyncio.AbstractEventLoop):
+        # the sync wrappers stop the loop, a debounced flush would never fire
+        if self._pending_query_flush is not None:
+            loop.run_until_complete(self.aflush())
+
+    def flush(self):
+        loop = always_get_an_event_loop()
+        return loop.run_until_complete(self.aflush())
+
+    async def aflush(self):
+        """Commit a pending debounced flush now, e.g. before shutting down"""
+        pending, self._pending_query_flush = self._pending_query_flush, None
+        await self._flush_storages([self.llm_response_cache, self.semantic_llm_cache])
+        if pending is not None and not pending.done():
+            # nothing left to write, its own flush on cancellation is a no-op
+            pending.cancel()
+            await asyncio.gather(pending, return_exceptions=True)
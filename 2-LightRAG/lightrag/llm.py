@@ -1,9 +1,14 @@
 import os
+import asyncio
 import copy
-from functools import lru_cache
+import importlib.util
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
 import json
 import aioboto3
 import aiohttp
+import httpx
 import numpy as np
 import ollama
 
@@ -13,6 +18,7 @@ from openai import (
     RateLimitError,
     Timeout,
     AsyncAzureOpenAI,
+    DefaultAsyncHttpxClient,
 )
 
 import base64
@@ -27,17 +33,117 @@ from tenacity import (
 from transformers import AutoTokenizer, AutoModelForCausalLM
 import torch
 from pydantic import BaseModel, Field
-from typing import List, Dict, Callable, Any
+from typing import List, Dict, Callable, Any, Optional
 from .base import BaseKVStorage
-from .utils import compute_args_hash, wrap_embedding_func_with_attrs
+from .utils import (
+    compute_args_hash,
+    report_rate_limit,
+    wrap_embedding_func_with_attrs,
+)
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
+# OpenAI/Azure clients are pooled per event loop, keyed by provider, endpoint
+# and credentials, so every call reuses the keep-alive connections of one client
+_openai_client_pool = weakref.WeakKeyDictionary()
+_openai_client_pool_config = {
+    "max_connections": 100,
+    "max_keepalive_connections": 20,
+    "http2": importlib.util.find_spec("h2") is not None,
+}
+_openai_client_pool_stats = {"hits": 0, "misses": 0}
+
+
+def configure_openai_client_pool(
+    max_connections: int = None,
+    max_keepalive_connections: int = None,
+    http2: bool = None,
+):
+    """Set the connection limits of OpenAI/Azure clients built from now on.
+    HTTP/2 needs the `h2` package and is on by default when it is installed.
+    """
+    if max_connections is not None:
+        _openai_client_pool_config["max_connections"] = max_connections
+    if max_keepalive_connections is not None:
+        _openai_client_pool_config["max_keepalive_connections"] = (
+            max_keepalive_connections
+        )
+    if http2 is not None:
+        if http2 and importlib.util.find_spec("h2") is None:
+            raise ImportError("HTTP/2 needs the h2 package: pip install httpx[http2]")
+        _openai_client_pool_config["http2"] = http2
+
+
+def openai_client_pool_stats() -> dict:
+    return {
+        **_openai_client_pool_stats,
+        "clients": sum(len(clients) for clients in _openai_client_pool.values()),
+    }
+
+
+def _get_openai_client(provider: str, **client_kwargs):
+    # httpx connections belong to the loop that opened them, hence one pool per loop
+    clients = _openai_client_pool.setdefault(asyncio.get_running_loop(), {})
+    key = (provider, *sorted(client_kwargs.items()))
+    client = clients.get(key)
+    if client is not None:
+        _openai_client_pool_stats["hits"] += 1
+        return client
+    _openai_client_pool_stats["misses"] += 1
+    http_client = DefaultAsyncHttpxClient(
+        http2=_openai_client_pool_config["http2"],
+        limits=httpx.Limits(
+            max_connections=_openai_client_pool_config["max_connections"],
+            max_keepalive_connections=_openai_client_pool_config[
+                "max_keepalive_connections"
+            ],
+        ),
+    )
+    client_cls = AsyncAzureOpenAI if provider == "azure" else AsyncOpenAI
+    client = client_cls(http_client=http_client, **client_kwargs)
+    clients[key] = client
+    return client
+
+
+def _openai_client(base_url: str = None) -> AsyncOpenAI:
+    return _get_openai_client(
+        "openai", base_url=base_url, api_key=os.getenv("OPENAI_API_KEY")
+    )
+
+
+def _azure_openai_client() -> AsyncAzureOpenAI:
+    return _get_openai_client(
+        "azure",
+        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
+        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
+        api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
+    )
+
+
+def _retry_after_seconds(exception: Exception) -> Optional[float]:
+    headers = getattr(getattr(exception, "response", None), "headers", None) or {}
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+def _report_rate_limit(retry_state):
+    """tenacity hook: let the call limiter back off before the retry sleeps"""
+    exception = retry_state.outcome.exception()
+    if isinstance(exception, RateLimitError):
+        report_rate_limit(_retry_after_seconds(exception))
+
 
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=4, max=10),
     retry=retry_if_exception_type((RateLimitError, APIConnectionError, Timeout)),
+    before_sleep=_report_rate_limit,
 )
 async def openai_complete_if_cache(
     model,
@@ -51,9 +157,7 @@ async def openai_complete_if_cache(
     if api_key:
         os.environ["OPENAI_API_KEY"] = api_key
 
-    openai_async_client = (
-        AsyncOpenAI() if base_url is None else AsyncOpenAI(base_url=base_url)
-    )
+    openai_async_client = _openai_client(base_url)
     hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
     messages = []
     if system_prompt:
@@ -81,6 +185,7 @@ async def openai_complete_if_cache(
     stop=stop_after_attempt(3),
     wait=wait_exponential(multiplier=1, min=4, max=10),
     retry=retry_if_exception_type((RateLimitError, APIConnectionError, Timeout)),
+    before_sleep=_report_rate_limit,
 )
 async def azure_openai_complete_if_cache(
     model,
@@ -96,11 +201,7 @@ async def azure_openai_complete_if_cache(
     if base_url:
         os.environ["AZURE_OPENAI_ENDPOINT"] = base_url
 
-    openai_async_client = AsyncAzureOpenAI(
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-        api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-    )
+    openai_async_client = _azure_openai_client()
 
     hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
     messages = []
@@ -215,8 +316,9 @@ async def bedrock_complete_if_cache(
         return response["output"]["message"]["content"][0]["text"]
 
 
-@lru_cache(maxsize=1)
+@lru_cache(maxsize=None)
 def initialize_hf_model(model_name):
+    """Load a model and its tokenizer once per process, every model stays loaded"""
     hf_tokenizer = AutoTokenizer.from_pretrained(
         model_name, device_map="auto", trust_remote_code=True
     )
@@ -225,16 +327,131 @@ def initialize_hf_model(model_name):
     )
     if hf_tokenizer.pad_token is None:
         hf_tokenizer.pad_token = hf_tokenizer.eos_token
+    # batched prompts must all end where generation starts
+    hf_tokenizer.padding_side = "left"
 
     return hf_model, hf_tokenizer
 
 
+class _MicroBatcher:
+    """Coalesces the requests of concurrent callers into one batch call.
+
+    Items submitted within `window` seconds of each other, up to `batch_size`
+    of them, go to `batch_func` together. It runs on a dedicated worker thread
+    so forward passes neither block the event loop nor compete for the CPU.
+    """
+
+    def __init__(self, batch_func: Callable, batch_size: int, window: float):
+        self.batch_func = batch_func
+        self.batch_size = batch_size
+        self.window = window
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending: list[tuple[Any, asyncio.Future]] = []
+        self._flush_handle: asyncio.TimerHandle = None
+
+    async def submit(self, items: list) -> list:
+        loop = asyncio.get_running_loop()
+        futures = []
+        for item in items:
+            futures.append(loop.create_future())
+            self._pending.append((item, futures[-1]))
+            if len(self._pending) >= self.batch_size:
+                self._flush()
+        if self._pending and self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+        return list(await asyncio.gather(*futures))
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run(batch))
+
+    async def _run(self, batch: list[tuple[Any, asyncio.Future]]):
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self.batch_func, [item for item, _ in batch]
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+# batchers keyed by id() of their model, which they only reference weakly; an
+# entry is closed and dropped when its model is garbage collected
+_hf_generate_batchers: dict[int, _MicroBatcher] = {}
+_hf_embed_batchers: dict[int, _MicroBatcher] = {}
+
+
+def _close_batcher(registry: dict[int, _MicroBatcher], key: int):
+    batcher = registry.pop(key, None)
+    if batcher is not None:
+        batcher.close()
+
+
+def _get_model_batcher(
+    registry: dict[int, _MicroBatcher],
+    model,
+    batch_func: Callable,
+    batch_size: int,
+    window: float,
+) -> _MicroBatcher:
+    """The batcher of ``model``, ``batch_func`` taking a weak reference to it"""
+    key = id(model)
+    if key not in registry:
+        registry[key] = _MicroBatcher(
+            partial(batch_func, weakref.ref(model)), batch_size, window
+        )
+        weakref.finalize(model, _close_batcher, registry, key)
+    return registry[key]
+
+
+def _deref_model(model_ref: weakref.ref):
+    model = model_ref()
+    if model is None:
+        raise RuntimeError("The model of this batch was released")
+    return model
+
+
+def _hf_generate_batch(
+    hf_tokenizer, hf_model_ref: weakref.ref, input_prompts: list[str]
+) -> list[str]:
+    hf_model = _deref_model(hf_model_ref)
+    inputs = hf_tokenizer(
+        input_prompts, return_tensors="pt", padding=True, truncation=True
+    ).to(hf_model.device)
+    with torch.no_grad():
+        output = hf_model.generate(
+            **inputs,
+            max_new_tokens=512,
+            num_return_sequences=1,
+            early_stopping=True,
+            pad_token_id=hf_tokenizer.pad_token_id,
+        )
+    return hf_tokenizer.batch_decode(
+        output[:, inputs["input_ids"].shape[1] :], skip_special_tokens=True
+    )
+
+
 async def hf_model_if_cache(
     model, prompt, system_prompt=None, history_messages=[], **kwargs
 ) -> str:
     model_name = model
     hf_model, hf_tokenizer = initialize_hf_model(model_name)
     hashing_kv: BaseKVStorage = kwargs.pop("hashing_kv", None)
+    # concurrent prompts are generated together, in one padded batch
+    batch_size = kwargs.pop("batch_size", 8)
+    batch_window = kwargs.pop("batch_window", 0.01)
     messages = []
     if system_prompt:
         messages.append({"role": "system", "content": system_prompt})
@@ -279,16 +496,14 @@ async def hf_model_if_cache(
                     + ">\n"
                 )
 
-    input_ids = hf_tokenizer(
-        input_prompt, return_tensors="pt", padding=True, truncation=True
-    ).to("cuda")
-    inputs = {k: v.to(hf_model.device) for k, v in input_ids.items()}
-    output = hf_model.generate(
-        **input_ids, max_new_tokens=512, num_return_sequences=1, early_stopping=True
-    )
-    response_text = hf_tokenizer.decode(
-        output[0][len(inputs["input_ids"][0]) :], skip_special_tokens=True
+    batcher = _get_model_batcher(
+        _hf_generate_batchers,
+        hf_model,
+        partial(_hf_generate_batch, hf_tokenizer),
+        batch_size,
+        batch_window,
     )
+    (response_text,) = await batcher.submit([input_prompt])
     if hashing_kv is not None:
         await hashing_kv.upsert({args_hash: {"return": response_text, "model": model}})
     return response_text
@@ -554,13 +769,11 @@ async def openai_embedding(
     if api_key:
         os.environ["OPENAI_API_KEY"] = api_key
 
-    openai_async_client = (
-        AsyncOpenAI() if base_url is None else AsyncOpenAI(base_url=base_url)
-    )
+    openai_async_client = _openai_client(base_url)
     response = await openai_async_client.embeddings.create(
         model=model, input=texts, encoding_format="float"
     )
-    return np.array([dp.embedding for dp in response.data])
+    return np.array([dp.embedding for dp in response.data], dtype=np.float32)
 
 
 @wrap_embedding_func_with_attrs(embedding_dim=1536, max_token_size=8192)
@@ -580,16 +793,12 @@ async def azure_openai_embedding(
     if base_url:
         os.environ["AZURE_OPENAI_ENDPOINT"] = base_url
 
-    openai_async_client = AsyncAzureOpenAI(
-        azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-        api_key=os.getenv("AZURE_OPENAI_API_KEY"),
-        api_version=os.getenv("AZURE_OPENAI_API_VERSION"),
-    )
+    openai_async_client = _azure_openai_client()
 
     response = await openai_async_client.embeddings.create(
         model=model, input=texts, encoding_format="float"
     )
-    return np.array([dp.embedding for dp in response.data])
+    return np.array([dp.embedding for dp in response.data], dtype=np.float32)
 
 
 @retry(
@@ -702,24 +911,71 @@ async def bedrock_embedding(
         return np.array(embed_texts)
 
 
-async def hf_embedding(texts: list[str], tokenizer, embed_model) -> np.ndarray:
-    input_ids = tokenizer(
-        texts, return_tensors="pt", padding=True, truncation=True
-    ).input_ids
+def _hf_embed_batch(
+    tokenizer, embed_model_ref: weakref.ref, texts: list[str]
+) -> list[np.ndarray]:
+    embed_model = _deref_model(embed_model_ref)
+    inputs = tokenizer(texts, return_tensors="pt", padding=True, truncation=True).to(
+        embed_model.device
+    )
     with torch.no_grad():
-        outputs = embed_model(input_ids)
-        embeddings = outputs.last_hidden_state.mean(dim=1)
-    return embeddings.detach().numpy()
+        outputs = embed_model(
+            input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"]
+        )
+    # mean over the real tokens only, so padding to the longest text in the
+    # batch leaves every embedding the same
+    mask = inputs["attention_mask"].unsqueeze(-1).to(outputs.last_hidden_state.dtype)
+    embeddings = (outputs.last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1).clamp(
+        min=1
+    )
+    return list(embeddings.float().cpu().numpy())
 
 
-async def ollama_embedding(texts: list[str], embed_model, **kwargs) -> np.ndarray:
-    embed_text = []
-    ollama_client = ollama.Client(**kwargs)
-    for text in texts:
-        data = ollama_client.embeddings(model=embed_model, prompt=text)
-        embed_text.append(data["embedding"])
+async def hf_embedding(
+    texts: list[str], tokenizer, embed_model, batch_size=32, batch_window=0.01
+) -> np.ndarray:
+    batcher = _get_model_batcher(
+        _hf_embed_batchers,
+        embed_model,
+        partial(_hf_embed_batch, tokenizer),
+        batch_size,
+        batch_window,
+    )
+    return np.stack(await batcher.submit(texts))
 
-    return embed_text
+
+# ollama_embedding reuses one AsyncClient per event loop and client settings
+_ollama_clients = weakref.WeakKeyDictionary()
+
+
+def _get_ollama_client(**kwargs) -> ollama.AsyncClient:
+    clients = _ollama_clients.setdefault(asyncio.get_running_loop(), {})
+    key = repr(sorted(kwargs.items()))
+    if key not in clients:
+        clients[key] = ollama.AsyncClient(**kwargs)
+    return clients[key]
+
+
+async def ollama_embedding(
+    texts: list[str], embed_model, batch_size=64, max_concurrency=4, **kwargs
+) -> np.ndarray:
+    ollama_client = _get_ollama_client(**kwargs)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def _embed_batch(batch: list[str]) -> list[list[float]]:
+        async with semaphore:
+            data = await ollama_client.embed(model=embed_model, input=batch)
+        return data["embeddings"]
+
+    results = await asyncio.gather(
+        *[
+            _embed_batch(texts[i : i + batch_size])
+            for i in range(0, len(texts), batch_size)
+        ]
+    )
+    return np.array(
+        [embedding for batch in results for embedding in batch], dtype=np.float32
+    )
 
 
 class Model(BaseModel):
@@ -2,14 +2,17 @@ import asyncio
 import json
 import re
 from typing import Union
-from collections import Counter, defaultdict
+from collections import Counter, OrderedDict, defaultdict
 import warnings
 from .utils import (
     logger,
     clean_str,
     compute_mdhash_id,
+    convert_response_to_json,
     decode_tokens_by_tiktoken,
+    decode_tokens_batch_by_tiktoken,
     encode_string_by_tiktoken,
+    encode_strings_by_tiktoken,
     is_float_regex,
     list_of_list_to_csv,
     pack_user_ass_to_openai_messages,
@@ -25,27 +28,72 @@ from .base import (
     QueryParam,
 )
 from .prompt import GRAPH_FIELD_SEP, PROMPTS
+from .storage import SemanticLLMCache
 
 
 def chunking_by_token_size(
     content: str, overlap_token_size=128, max_token_size=1024, tiktoken_model="gpt-4o"
 ):
     tokens = encode_string_by_tiktoken(content, model_name=tiktoken_model)
-    results = []
-    for index, start in enumerate(
-        range(0, len(tokens), max_token_size - overlap_token_size)
-    ):
-        chunk_content = decode_tokens_by_tiktoken(
-            tokens[start : start + max_token_size], model_name=tiktoken_model
-        )
-        results.append(
-            {
-                "tokens": min(max_token_size, len(tokens) - start),
-                "content": chunk_content.strip(),
-                "chunk_order_index": index,
-            }
+    return _chunking_tokens(tokens, overlap_token_size, max_token_size, tiktoken_model)
+
+
+def _chunking_tokens(
+    tokens: list[int], overlap_token_size, max_token_size, tiktoken_model
+) -> list[dict]:
+    # every overlapping window is sliced from the one token array of the doc
+    starts = range(0, len(tokens), max_token_size - overlap_token_size)
+    chunk_contents = decode_tokens_batch_by_tiktoken(
+        [tokens[start : start + max_token_size] for start in starts],
+        model_name=tiktoken_model,
+    )
+    return [
+        {
+            "tokens": min(max_token_size, len(tokens) - start),
+            "content": chunk_content.strip(),
+            "chunk_order_index": index,
+        }
+        for index, (start, chunk_content) in enumerate(zip(starts, chunk_contents))
+    ]
+
+
+def _chunking_batch(
+    contents: list[str], overlap_token_size, max_token_size, tiktoken_model
+) -> list[list[dict]]:
+    return [
+        _chunking_tokens(tokens, overlap_token_size, max_token_size, tiktoken_model)
+        for tokens in encode_strings_by_tiktoken(contents, model_name=tiktoken_model)
+    ]
+
+
+async def chunking_documents(
+    docs: dict[str, str],
+    overlap_token_size=128,
+    max_token_size=1024,
+    tiktoken_model="gpt-4o",
+    docs_per_batch=16,
+):
+    """Chunk documents like chunking_by_token_size, off the event loop.
+
+    Documents are tokenized in batches on a worker thread, tiktoken encodes
+    and decodes a batch on its own threads, and ``(doc_key, chunk)`` pairs
+    are yielded as soon as their batch is done.
+    """
+    loop = asyncio.get_running_loop()
+    doc_keys = list(docs.keys())
+    for i in range(0, len(doc_keys), docs_per_batch):
+        batch_keys = doc_keys[i : i + docs_per_batch]
+        batch_chunks = await loop.run_in_executor(
+            None,
+            _chunking_batch,
+            [docs[k] for k in batch_keys],
+            overlap_token_size,
+            max_token_size,
+            tiktoken_model,
         )
-    return results
+        for doc_key, chunks in zip(batch_keys, batch_chunks):
+            for chunk in chunks:
+                yield doc_key, chunk
 
 
 async def _handle_entity_relation_summary(
@@ -54,17 +102,15 @@ async def _handle_entity_relation_summary(
     global_config: dict,
 ) -> str:
     use_llm_func: callable = global_config["llm_model_func"]
-    llm_max_tokens = global_config["llm_model_max_token_size"]
     tiktoken_model_name = global_config["tiktoken_model_name"]
     summary_max_tokens = global_config["entity_summary_to_max_tokens"]
 
-    tokens = encode_string_by_tiktoken(description, model_name=tiktoken_model_name)
-    if len(tokens) < summary_max_tokens:  # No need for summary
+    if (
+        _count_description_tokens(description, tiktoken_model_name) < summary_max_tokens
+    ):  # No need for summary
         return description
     prompt_template = PROMPTS["summarize_entity_descriptions"]
-    use_description = decode_tokens_by_tiktoken(
-        tokens[:llm_max_tokens], model_name=tiktoken_model_name
-    )
+    use_description = _truncate_description(description, global_config)
     context_base = dict(
         entity_name=entity_or_relation_name,
         description_list=use_description.split(GRAPH_FIELD_SEP),
@@ -75,6 +121,155 @@ async def _handle_entity_relation_summary(
     return summary
 
 
+# merged descriptions are measured again every time their entity is merged;
+# they can be many KB each, so the cache is keyed by digest and length
+_DESCRIPTION_TOKENS_CACHE_SIZE = 65536
+_description_tokens: OrderedDict[tuple[str, int, str], int] = OrderedDict()
+
+
+def _count_description_tokens(description: str, tiktoken_model_name: str) -> int:
+    key = (compute_mdhash_id(description), len(description), tiktoken_model_name)
+    tokens = _description_tokens.get(key)
+    if tokens is not None:
+        _description_tokens.move_to_end(key)
+        return tokens
+    tokens = len(encode_string_by_tiktoken(description, model_name=tiktoken_model_name))
+    _description_tokens[key] = tokens
+    if len(_description_tokens) > _DESCRIPTION_TOKENS_CACHE_SIZE:
+        _description_tokens.popitem(last=False)
+    return tokens
+
+
+def _truncate_description(description: str, global_config: dict) -> str:
+    llm_max_tokens = global_config["llm_model_max_token_size"]
+    tiktoken_model_name = global_config["tiktoken_model_name"]
+    if _count_description_tokens(description, tiktoken_model_name) <= llm_max_tokens:
+        return description
+    tokens = encode_string_by_tiktoken(description, model_name=tiktoken_model_name)
+    return decode_tokens_by_tiktoken(
+        tokens[:llm_max_tokens], model_name=tiktoken_model_name
+    )
+
+
+# how long a summary request waits for others to share its packed prompt
+_SUMMARY_BATCH_WINDOW = 0.05
+
+
+class _DescriptionSummarizer:
+    """Summarizes over-long entity and relation descriptions.
+
+    Up to ``entity_summary_batch_size`` descriptions waiting at the same time
+    share one packed prompt; items missing from the JSON answer fall back to
+    a single summary call. Summaries are cached by name and description set,
+    so merging the same descriptions again costs no LLM call.
+    """
+
+    def __init__(self, global_config: dict, summary_cache: BaseKVStorage = None):
+        self.global_config = global_config
+        self.summary_cache = summary_cache
+        self.batch_size = global_config.get("entity_summary_batch_size", 1)
+        self._pending: list[tuple[str, str, asyncio.Future]] = []
+        self._pending_tokens = 0
+        self._flush_handle: asyncio.TimerHandle = None
+        self._batches: set[asyncio.Task] = set()
+
+    async def summarize(self, name: Union[str, tuple], description: str) -> str:
+        if (
+            _count_description_tokens(
+                description, self.global_config["tiktoken_model_name"]
+            )
+            < self.global_config["entity_summary_to_max_tokens"]
+        ):
+            return description
+        cache_key = compute_mdhash_id(
+            f"{name}{GRAPH_FIELD_SEP}{description}", prefix="summary-"
+        )
+        if self.summary_cache is not None:
+            cached = await self.summary_cache.get_by_id(cache_key)
+            if cached is not None:
+                return cached["summary"]
+        if self.batch_size > 1:
+            summary = await self._enqueue(name, description)
+        else:
+            summary = await _handle_entity_relation_summary(
+                name, description, self.global_config
+            )
+        if self.summary_cache is not None:
+            await self.summary_cache.upsert({cache_key: {"summary": summary}})
+        return summary
+
+    async def _enqueue(self, name: Union[str, tuple], description: str) -> str:
+        description = _truncate_description(description, self.global_config)
+        tokens = _count_description_tokens(
+            description, self.global_config["tiktoken_model_name"]
+        )
+        if (
+            self._pending
+            and self._pending_tokens + tokens
+            > self.global_config["llm_model_max_token_size"]
+        ):
+            self._flush()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((name, description, future))
+        self._pending_tokens += tokens
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(_SUMMARY_BATCH_WINDOW, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending, self._pending_tokens = self._pending, [], 0
+        if batch:
+            task = asyncio.ensure_future(self._summarize_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _summarize_batch(self, batch: list[tuple[str, str, asyncio.Future]]):
+        use_llm_func: callable = self.global_config["llm_model_func"]
+        summary_max_tokens = self.global_config["entity_summary_to_max_tokens"]
+        summaries = {}
+        if len(batch) > 1:
+            items = [
+                {
+                    "id": str(i),
+                    "entities": name,
+                    "descriptions": description.split(GRAPH_FIELD_SEP),
+                }
+                for i, (name, description, _) in enumerate(batch)
+            ]
+            use_prompt = PROMPTS["summarize_entity_descriptions_batch"].format(
+                items=json.dumps(items, ensure_ascii=False)
+            )
+            logger.debug(f"Trigger batched summary: {len(batch)} descriptions")
+            try:
+                summaries = convert_response_to_json(
+                    await use_llm_func(
+                        use_prompt, max_tokens=summary_max_tokens * len(batch)
+                    )
+                )
+            except Exception as e:
+                logger.warning(f"Batched summary failed, summarizing one by one: {e}")
+
+        async def _resolve(i: int, name, description: str, future):
+            summary = summaries.get(str(i))
+            try:
+                if not isinstance(summary, str) or not summary.strip():
+                    summary = await _handle_entity_relation_summary(
+                        name, description, self.global_config
+                    )
+            except Exception as e:
+                future.set_exception(e)
+                return
+            future.set_result(summary)
+
+        await asyncio.gather(*[_resolve(i, *item) for i, item in enumerate(batch)])
+
+
 async def _handle_single_entity_extraction(
     record_attributes: list[str],
     chunk_key: str,
@@ -127,6 +322,7 @@ async def _merge_nodes_then_upsert(
     nodes_data: list[dict],
     knowledge_graph_inst: BaseGraphStorage,
     global_config: dict,
+    summarizer: _DescriptionSummarizer = None,
 ):
     already_entitiy_types = []
     already_source_ids = []
@@ -153,9 +349,12 @@ async def _merge_nodes_then_upsert(
     source_id = GRAPH_FIELD_SEP.join(
         set([dp["source_id"] for dp in nodes_data] + already_source_ids)
     )
-    description = await _handle_entity_relation_summary(
-        entity_name, description, global_config
-    )
+    if summarizer is not None:
+        description = await summarizer.summarize(entity_name, description)
+    else:
+        description = await _handle_entity_relation_summary(
+            entity_name, description, global_config
+        )
     node_data = dict(
         entity_type=entity_type,
         description=description,
@@ -175,6 +374,7 @@ async def _merge_edges_then_upsert(
     edges_data: list[dict],
     knowledge_graph_inst: BaseGraphStorage,
     global_config: dict,
+    summarizer: _DescriptionSummarizer = None,
 ):
     already_weights = []
     already_source_ids = []
@@ -212,9 +412,12 @@ async def _merge_edges_then_upsert(
                     "entity_type": '"UNKNOWN"',
                 },
             )
-    description = await _handle_entity_relation_summary(
-        (src_id, tgt_id), description, global_config
-    )
+    if summarizer is not None:
+        description = await summarizer.summarize((src_id, tgt_id), description)
+    else:
+        description = await _handle_entity_relation_summary(
+            (src_id, tgt_id), description, global_config
+        )
     await knowledge_graph_inst.upsert_edge(
         src_id,
         tgt_id,
@@ -242,9 +445,23 @@ async def extract_entities(
     entity_vdb: BaseVectorStorage,
     relationships_vdb: BaseVectorStorage,
     global_config: dict,
+    checkpoint_callback: callable = None,
+    resumed_deferred_edges: list[dict] = None,
+    summary_cache: BaseKVStorage = None,
 ) -> Union[BaseGraphStorage, None]:
+    """Extract entities and relationships from ``chunks`` into the graph.
+
+    Chunk results are merged in windows of ``insert_checkpoint_interval``
+    chunks, each entity and relationship once per window. After every full
+    window pending vdb writes are drained and ``checkpoint_callback`` is
+    awaited with ``{chunk_key: {"deferred_edges": [...]}}`` for the chunks of
+    the window. Passing those deferred edges back as
+    ``resumed_deferred_edges`` lets an interrupted run finish them.
+    Over-long descriptions are summarized through ``summary_cache`` when given.
+    """
     use_llm_func: callable = global_config["llm_model_func"]
     entity_extract_max_gleaning = global_config["entity_extract_max_gleaning"]
+    checkpoint_interval = global_config.get("insert_checkpoint_interval", 0)
 
     ordered_chunks = list(chunks.items())
 
@@ -272,7 +489,10 @@ async def extract_entities(
 
         history = pack_user_ass_to_openai_messages(hint_prompt, final_result)
         for now_glean_index in range(entity_extract_max_gleaning):
-            glean_result = await use_llm_func(continue_prompt, history_messages=history)
+            # gleaning yields to first-pass extraction of the other chunks
+            glean_result = await use_llm_func(
+                continue_prompt, history_messages=history, priority=1
+            )
 
             history += pack_user_ass_to_openai_messages(continue_prompt, glean_result)
             final_result += glean_result
@@ -280,7 +500,7 @@ async def extract_entities(
                 break
 
             if_loop_result: str = await use_llm_func(
-                if_loop_prompt, history_messages=history
+                if_loop_prompt, history_messages=history, priority=1
             )
             if_loop_result = if_loop_result.strip().strip('"').strip("'").lower()
             if if_loop_result != "yes":
@@ -326,65 +546,199 @@ async def extract_entities(
             end="",
             flush=True,
         )
-        return dict(maybe_nodes), dict(maybe_edges)
-
-    # use_llm_func is wrapped in ascynio.Semaphore, limiting max_async callings
-    results = await asyncio.gather(
-        *[_process_single_content(c) for c in ordered_chunks]
-    )
-    print()  # clear the progress bar
-    maybe_nodes = defaultdict(list)
-    maybe_edges = defaultdict(list)
-    for m_nodes, m_edges in results:
-        for k, v in m_nodes.items():
-            maybe_nodes[k].extend(v)
-        for k, v in m_edges.items():
-            maybe_edges[tuple(sorted(k))].extend(v)
-    all_entities_data = await asyncio.gather(
-        *[
-            _merge_nodes_then_upsert(k, v, knowledge_graph_inst, global_config)
-            for k, v in maybe_nodes.items()
-        ]
-    )
-    all_relationships_data = await asyncio.gather(
-        *[
-            _merge_edges_then_upsert(k[0], k[1], v, knowledge_graph_inst, global_config)
-            for k, v in maybe_edges.items()
-        ]
+        await merge_queue.put((chunk_key, dict(maybe_nodes), dict(maybe_edges)))
+
+    # Chunk results are collected per window of ``insert_checkpoint_interval``
+    # chunks (the whole run when 0) and every entity/relationship of a window
+    # is merged, and summarized, once while later chunks are still being
+    # extracted; merged entities/relationships stream to the vdbs in batches.
+    # Edges whose endpoints have not been extracted yet are held back to the
+    # end, where missing endpoints get placeholder nodes as before, so a
+    # placeholder never shadows an entity found in a later chunk.
+    merge_queue: asyncio.Queue = asyncio.Queue()
+    summarizer = _DescriptionSummarizer(global_config, summary_cache)
+    deferred_edges: dict[tuple, list[dict]] = defaultdict(list)
+    for edge in resumed_deferred_edges or []:
+        deferred_edges[tuple(sorted((edge["src_id"], edge["tgt_id"])))].append(edge)
+    chunk_deferred_edges: dict[str, list[dict]] = {}
+    merged_entities = set()
+    merged_relationships = set()
+    vdb_batch_size = global_config.get("embedding_batch_num", 32) * global_config.get(
+        "embedding_func_max_async", 16
     )
-    if not len(all_entities_data):
+    entity_queue: asyncio.Queue = asyncio.Queue()
+    relationship_queue: asyncio.Queue = asyncio.Queue()
+
+    async def _merge_node(entity_name: str, nodes_data: list[dict]):
+        dp = await _merge_nodes_then_upsert(
+            entity_name,
+            nodes_data,
+            knowledge_graph_inst,
+            global_config,
+            summarizer,
+        )
+        merged_entities.add(entity_name)
+        await entity_queue.put(
+            (
+                compute_mdhash_id(dp["entity_name"], prefix="ent-"),
+                {
+                    "content": dp["entity_name"] + dp["description"],
+                    "entity_name": dp["entity_name"],
+                },
+            )
+        )
+
+    async def _merge_edge(edge_key: tuple, edges_data: list[dict]):
+        dp = await _merge_edges_then_upsert(
+            edge_key[0],
+            edge_key[1],
+            edges_data,
+            knowledge_graph_inst,
+            global_config,
+            summarizer,
+        )
+        merged_relationships.add(edge_key)
+        await relationship_queue.put(
+            (
+                compute_mdhash_id(dp["src_id"] + dp["tgt_id"], prefix="rel-"),
+                {
+                    "src_id": dp["src_id"],
+                    "tgt_id": dp["tgt_id"],
+                    "content": dp["keywords"]
+                    + dp["src_id"]
+                    + dp["tgt_id"]
+                    + dp["description"],
+                },
+            )
+        )
+
+    async def _merge_window(window_nodes: dict, window_edges: dict):
+        await asyncio.gather(*[_merge_node(k, v) for k, v in window_nodes.items()])
+        ready_edges = {}
+        for edge_key, edges in window_edges.items():
+            if all(
+                await asyncio.gather(
+                    *[knowledge_graph_inst.has_node(n) for n in edge_key]
+                )
+            ):
+                ready_edges[edge_key] = edges
+                continue
+            deferred_edges[edge_key].extend(edges)
+            for edge in edges:
+                chunk_deferred_edges.setdefault(edge["source_id"], []).append(edge)
+        await asyncio.gather(*[_merge_edge(k, v) for k, v in ready_edges.items()])
+
+    async def _drain(queue: asyncio.Queue, writer: asyncio.Task):
+        flushed = asyncio.get_running_loop().create_future()
+        await queue.put(flushed)
+        # a writer that died on a failed upsert never answers the flush
+        await asyncio.wait([flushed, writer], return_when=asyncio.FIRST_COMPLETED)
+        if not flushed.done():
+            writer.result()
+            raise RuntimeError("vdb writer stopped before the checkpoint")
+
+    async def _checkpoint(chunk_keys: list[str]):
+        await asyncio.gather(
+            _drain(entity_queue, pipeline[1]), _drain(relationship_queue, pipeline[2])
+        )
+        await checkpoint_callback(
+            {k: {"deferred_edges": chunk_deferred_edges.pop(k, [])} for k in chunk_keys}
+        )
+
+    async def _merger():
+        window_chunks = []
+        window_nodes = defaultdict(list)
+        window_edges = defaultdict(list)
+        while (item := await merge_queue.get()) is not None:
+            chunk_key, m_nodes, m_edges = item
+            window_chunks.append(chunk_key)
+            for k, v in m_nodes.items():
+                window_nodes[k].extend(v)
+            for k, v in m_edges.items():
+                window_edges[tuple(sorted(k))].extend(v)
+            if checkpoint_interval and len(window_chunks) >= checkpoint_interval:
+                # extraction keeps filling the queue while the window is merged
+                await _merge_window(window_nodes, window_edges)
+                if checkpoint_callback is not None:
+                    await _checkpoint(window_chunks)
+                window_chunks = []
+                window_nodes = defaultdict(list)
+                window_edges = defaultdict(list)
+        await _merge_window(window_nodes, window_edges)
+
+    async def _until_done(awaitable):
+        """Await while watching the pipeline, so extraction stops as soon as a
+        merge or vdb write fails instead of running (or waiting) on without it"""
+        task = asyncio.ensure_future(awaitable)
+        try:
+            while not task.done():
+                done, _ = await asyncio.wait(
+                    [task, *[t for t in pipeline if not t.done()]],
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for finished in done:
+                    if finished is not task:
+                        finished.result()
+            return task.result()
+        finally:
+            if not task.done():
+                task.cancel()
+                # retrieve the outcome, the pipeline error is the one raised
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+
+    async def _vdb_writer(vdb: BaseVectorStorage, queue: asyncio.Queue):
+        # a single writer per vdb, so concurrent upserts never race on new ids
+        batch = {}
+        while (item := await queue.get()) is not None:
+            if isinstance(item, asyncio.Future):
+                if batch:
+                    await vdb.upsert(batch)
+                    batch = {}
+                item.set_result(None)
+                continue
+            if vdb is None:
+                continue
+            # a re-merged entity only needs its latest description embedded
+            batch[item[0]] = item[1]
+            if len(batch) >= vdb_batch_size:
+                await vdb.upsert(batch)
+                batch = {}
+        if batch:
+            await vdb.upsert(batch)
+
+    pipeline = [
+        asyncio.ensure_future(_merger()),
+        asyncio.ensure_future(_vdb_writer(entity_vdb, entity_queue)),
+        asyncio.ensure_future(_vdb_writer(relationships_vdb, relationship_queue)),
+    ]
+    try:
+        # use_llm_func is wrapped in a FIFO limiter, limiting max_async callings
+        await _until_done(
+            asyncio.gather(*[_process_single_content(c) for c in ordered_chunks])
+        )
+        print()  # clear the progress bar
+        await merge_queue.put(None)
+        await _until_done(pipeline[0])
+        await _until_done(
+            asyncio.gather(*[_merge_edge(k, v) for k, v in deferred_edges.items()])
+        )
+        await entity_queue.put(None)
+        await relationship_queue.put(None)
+        await asyncio.gather(*pipeline[1:])
+    finally:
+        for task in pipeline:
+            if not task.done():
+                task.cancel()
+
+    if not len(merged_entities):
         logger.warning("Didn't extract any entities, maybe your LLM is not working")
         return None
-    if not len(all_relationships_data):
+    if not len(merged_relationships):
         logger.warning(
             "Didn't extract any relationships, maybe your LLM is not working"
         )
         return None
 
-    if entity_vdb is not None:
-        data_for_vdb = {
-            compute_mdhash_id(dp["entity_name"], prefix="ent-"): {
-                "content": dp["entity_name"] + dp["description"],
-                "entity_name": dp["entity_name"],
-            }
-            for dp in all_entities_data
-        }
-        await entity_vdb.upsert(data_for_vdb)
-
-    if relationships_vdb is not None:
-        data_for_vdb = {
-            compute_mdhash_id(dp["src_id"] + dp["tgt_id"], prefix="rel-"): {
-                "src_id": dp["src_id"],
-                "tgt_id": dp["tgt_id"],
-                "content": dp["keywords"]
-                + dp["src_id"]
-                + dp["tgt_id"]
-                + dp["description"],
-            }
-            for dp in all_relationships_data
-        }
-        await relationships_vdb.upsert(data_for_vdb)
-
     return knowledge_graph_inst
 
 
@@ -396,18 +750,79 @@ async def local_query(
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     query_param: QueryParam,
     global_config: dict,
+    semantic_cache: SemanticLLMCache = None,
 ) -> str:
+    cached_response = await _lookup_answer(query, query_param, semantic_cache)
+    if cached_response is not None:
+        return cached_response
     context = None
     use_model_func = global_config["llm_model_func"]
 
+    keywords_data = await _extract_keywords(query, use_model_func, semantic_cache)
+    if keywords_data is None:
+        return PROMPTS["fail_response"]
+    keywords = ", ".join(keywords_data.get("low_level_keywords", []))
+    if keywords:
+        context = await _build_local_query_context(
+            keywords,
+            knowledge_graph_inst,
+            entities_vdb,
+            text_chunks_db,
+            query_param,
+        )
+    response = await _respond_with_context(query, context, query_param, use_model_func)
+    return await _store_answer(query, query_param, semantic_cache, response)
+
+
+# answers go stale once the graph changes, the extracted keywords do not
+ANSWER_TIER_PREFIX = "answer:"
+
+
+def _answer_tier(query_param: QueryParam) -> str:
+    return f"{ANSWER_TIER_PREFIX}{query_param.mode}:{query_param.response_type}"
+
+
+async def _lookup_answer(
+    query, query_param: QueryParam, semantic_cache: SemanticLLMCache
+) -> Union[str, None]:
+    """The answer to a similar earlier query, if the semantic cache has one"""
+    if semantic_cache is None or query_param.only_need_context:
+        return None
+    return await semantic_cache.lookup(_answer_tier(query_param), query)
+
+
+async def _store_answer(
+    query, query_param: QueryParam, semantic_cache: SemanticLLMCache, response
+):
+    if (
+        semantic_cache is not None
+        and not query_param.only_need_context
+        and response != PROMPTS["fail_response"]
+    ):
+        await semantic_cache.store(_answer_tier(query_param), query, response)
+    return response
+
+
+async def _extract_keywords(
+    query, use_model_func, semantic_cache: SemanticLLMCache = None
+) -> Union[dict, None]:
+    if semantic_cache is not None:
+        keywords_data = await semantic_cache.lookup("keywords", query)
+        if keywords_data is not None:
+            return keywords_data
     kw_prompt_temp = PROMPTS["keywords_extraction"]
     kw_prompt = kw_prompt_temp.format(query=query)
     result = await use_model_func(kw_prompt)
 
+    keywords_data = _parse_keywords(result, kw_prompt)
+    if keywords_data is not None and semantic_cache is not None:
+        await semantic_cache.store("keywords", query, keywords_data)
+    return keywords_data
+
+
+def _parse_keywords(result: str, kw_prompt: str) -> Union[dict, None]:
     try:
-        keywords_data = json.loads(result)
-        keywords = keywords_data.get("low_level_keywords", [])
-        keywords = ", ".join(keywords)
+        return json.loads(result)
     except json.JSONDecodeError:
         try:
             result = (
@@ -417,22 +832,16 @@ async def local_query(
                 .strip()
             )
             result = "{" + result.split("{")[1].split("}")[0] + "}"
-
-            keywords_data = json.loads(result)
-            keywords = keywords_data.get("low_level_keywords", [])
-            keywords = ", ".join(keywords)
+            return json.loads(result)
         # Handle parsing error
         except json.JSONDecodeError as e:
             print(f"JSON parsing error: {e}")
-            return PROMPTS["fail_response"]
-    if keywords:
-        context = await _build_local_query_context(
-            keywords,
-            knowledge_graph_inst,
-            entities_vdb,
-            text_chunks_db,
-            query_param,
-        )
+            return None
+
+
+async def _respond_with_context(
+    query, context, query_param: QueryParam, use_model_func
+) -> str:
     if query_param.only_need_context:
         return context
     if context is None:
@@ -465,20 +874,21 @@ async def _build_local_query_context(
     entities_vdb: BaseVectorStorage,
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     query_param: QueryParam,
+    vdb_results: list[dict] = None,
 ):
-
-    results = await entities_vdb.query(query, top_k=query_param.top_k)
+    results = (
+        vdb_results
+        if vdb_results is not None
+        else await entities_vdb.query(query, top_k=query_param.top_k)
+    )
 
     if not len(results):
         return None
-    node_datas = await asyncio.gather(
-        *[knowledge_graph_inst.get_node(r["entity_name"]) for r in results]
-    )
+    entity_names = [r["entity_name"] for r in results]
+    node_datas = await knowledge_graph_inst.get_nodes_batch(entity_names)
     if not all([n is not None for n in node_datas]):
         logger.warning("Some nodes are missing, maybe the storage is damaged")
-    node_degrees = await asyncio.gather(
-        *[knowledge_graph_inst.node_degree(r["entity_name"]) for r in results]
-    )
+    node_degrees = await knowledge_graph_inst.node_degrees_batch(entity_names)
     node_datas = [
         {**n, "entity_name": k["entity_name"], "rank": d}
         for k, n, d in zip(results, node_datas, node_degrees)
@@ -553,8 +963,8 @@ async def _find_most_related_text_unit_from_entities(
         split_string_by_multi_markers(dp["source_id"], [GRAPH_FIELD_SEP])
         for dp in node_datas
     ]
-    edges = await asyncio.gather(
-        *[knowledge_graph_inst.get_node_edges(dp["entity_name"]) for dp in node_datas]
+    edges = await knowledge_graph_inst.get_nodes_edges_batch(
+        [dp["entity_name"] for dp in node_datas]
     )
     all_one_hop_nodes = set()
     for this_edges in edges:
@@ -563,8 +973,8 @@ async def _find_most_related_text_unit_from_entities(
         all_one_hop_nodes.update([e[1] for e in this_edges])
     
     all_one_hop_nodes = list(all_one_hop_nodes)
-    all_one_hop_nodes_data = await asyncio.gather(
-        *[knowledge_graph_inst.get_node(e) for e in all_one_hop_nodes]
+    all_one_hop_nodes_data = await knowledge_graph_inst.get_nodes_batch(
+        all_one_hop_nodes
     )
     
     # Add null check for node data
@@ -574,6 +984,11 @@ async def _find_most_related_text_unit_from_entities(
         if v is not None and "source_id" in v  # Add source_id check
     }
     
+    all_chunk_ids = list(dict.fromkeys(c for units in text_units for c in units))
+    all_chunks = dict(
+        zip(all_chunk_ids, await text_chunks_db.get_by_ids(all_chunk_ids))
+    )
+
     all_text_units_lookup = {}
     for index, (this_text_units, this_edges) in enumerate(zip(text_units, edges)):
         for c_id in this_text_units:
@@ -588,7 +1003,7 @@ async def _find_most_related_text_unit_from_entities(
                     ):
                         relation_counts += 1
             
-            chunk_data = await text_chunks_db.get_by_id(c_id)
+            chunk_data = all_chunks[c_id]
             if chunk_data is not None and "content" in chunk_data:  # Add content check
                 all_text_units_lookup[c_id] = {
                     "data": chunk_data,
@@ -627,19 +1042,15 @@ async def _find_most_related_edges_from_entities(
     query_param: QueryParam,
     knowledge_graph_inst: BaseGraphStorage,
 ):
-    all_related_edges = await asyncio.gather(
-        *[knowledge_graph_inst.get_node_edges(dp["entity_name"]) for dp in node_datas]
+    all_related_edges = await knowledge_graph_inst.get_nodes_edges_batch(
+        [dp["entity_name"] for dp in node_datas]
     )
     all_edges = set()
     for this_edges in all_related_edges:
-        all_edges.update([tuple(sorted(e)) for e in this_edges])
+        all_edges.update([tuple(sorted(e)) for e in this_edges or []])
     all_edges = list(all_edges)
-    all_edges_pack = await asyncio.gather(
-        *[knowledge_graph_inst.get_edge(e[0], e[1]) for e in all_edges]
-    )
-    all_edges_degree = await asyncio.gather(
-        *[knowledge_graph_inst.edge_degree(e[0], e[1]) for e in all_edges]
-    )
+    all_edges_pack = await knowledge_graph_inst.get_edges_batch(all_edges)
+    all_edges_degree = await knowledge_graph_inst.edge_degrees_batch(all_edges)
     all_edges_data = [
         {"src_tgt": k, "rank": d, **v}
         for k, v, d in zip(all_edges, all_edges_pack, all_edges_degree)
@@ -664,36 +1075,18 @@ async def global_query(
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     query_param: QueryParam,
     global_config: dict,
+    semantic_cache: SemanticLLMCache = None,
 ) -> str:
+    cached_response = await _lookup_answer(query, query_param, semantic_cache)
+    if cached_response is not None:
+        return cached_response
     context = None
     use_model_func = global_config["llm_model_func"]
 
-    kw_prompt_temp = PROMPTS["keywords_extraction"]
-    kw_prompt = kw_prompt_temp.format(query=query)
-    result = await use_model_func(kw_prompt)
-
-    try:
-        keywords_data = json.loads(result)
-        keywords = keywords_data.get("high_level_keywords", [])
-        keywords = ", ".join(keywords)
-    except json.JSONDecodeError:
-        try:
-            result = (
-                result.replace(kw_prompt[:-1], "")
-                .replace("user", "")
-                .replace("model", "")
-                .strip()
-            )
-            result = "{" + result.split("{")[1].split("}")[0] + "}"
-
-            keywords_data = json.loads(result)
-            keywords = keywords_data.get("high_level_keywords", [])
-            keywords = ", ".join(keywords)
-
-        except json.JSONDecodeError as e:
-            # Handle parsing error
-            print(f"JSON parsing error: {e}")
-            return PROMPTS["fail_response"]
+    keywords_data = await _extract_keywords(query, use_model_func, semantic_cache)
+    if keywords_data is None:
+        return PROMPTS["fail_response"]
+    keywords = ", ".join(keywords_data.get("high_level_keywords", []))
     if keywords:
         context = await _build_global_query_context(
             keywords,
@@ -703,32 +1096,8 @@ async def global_query(
             text_chunks_db,
             query_param,
         )
-
-    if query_param.only_need_context:
-        return context
-    if context is None:
-        return PROMPTS["fail_response"]
-
-    sys_prompt_temp = PROMPTS["rag_response"]
-    sys_prompt = sys_prompt_temp.format(
-        context_data=context, response_type=query_param.response_type
-    )
-    response = await use_model_func(
-        query,
-        system_prompt=sys_prompt,
-    )
-    if len(response) > len(sys_prompt):
-        response = (
-            response.replace(sys_prompt, "")
-            .replace("user", "")
-            .replace("model", "")
-            .replace(query, "")
-            .replace("<system>", "")
-            .replace("</system>", "")
-            .strip()
-        )
-
-    return response
+    response = await _respond_with_context(query, context, query_param, use_model_func)
+    return await _store_answer(query, query_param, semantic_cache, response)
 
 
 async def _build_global_query_context(
@@ -738,21 +1107,23 @@ async def _build_global_query_context(
     relationships_vdb: BaseVectorStorage,
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     query_param: QueryParam,
+    vdb_results: list[dict] = None,
 ):
-    results = await relationships_vdb.query(keywords, top_k=query_param.top_k)
+    results = (
+        vdb_results
+        if vdb_results is not None
+        else await relationships_vdb.query(keywords, top_k=query_param.top_k)
+    )
 
     if not len(results):
         return None
 
-    edge_datas = await asyncio.gather(
-        *[knowledge_graph_inst.get_edge(r["src_id"], r["tgt_id"]) for r in results]
-    )
+    edge_pairs = [(r["src_id"], r["tgt_id"]) for r in results]
+    edge_datas = await knowledge_graph_inst.get_edges_batch(edge_pairs)
 
     if not all([n is not None for n in edge_datas]):
         logger.warning("Some edges are missing, maybe the storage is damaged")
-    edge_degree = await asyncio.gather(
-        *[knowledge_graph_inst.edge_degree(r["src_id"], r["tgt_id"]) for r in results]
-    )
+    edge_degree = await knowledge_graph_inst.edge_degrees_batch(edge_pairs)
     edge_datas = [
         {"src_id": k["src_id"], "tgt_id": k["tgt_id"], "rank": d, **v}
         for k, v, d in zip(results, edge_datas, edge_degree)
@@ -836,14 +1207,11 @@ async def _find_most_related_entities_from_relationships(
     for e in edge_datas:
         entity_names.add(e["src_id"])
         entity_names.add(e["tgt_id"])
+    entity_names = list(entity_names)
 
-    node_datas = await asyncio.gather(
-        *[knowledge_graph_inst.get_node(entity_name) for entity_name in entity_names]
-    )
+    node_datas = await knowledge_graph_inst.get_nodes_batch(entity_names)
 
-    node_degrees = await asyncio.gather(
-        *[knowledge_graph_inst.node_degree(entity_name) for entity_name in entity_names]
-    )
+    node_degrees = await knowledge_graph_inst.node_degrees_batch(entity_names)
     node_datas = [
         {**n, "entity_name": k, "rank": d}
         for k, n, d in zip(entity_names, node_datas, node_degrees)
@@ -869,13 +1237,18 @@ async def _find_related_text_unit_from_relationships(
         for dp in edge_datas
     ]
 
+    all_chunk_ids = list(dict.fromkeys(c for units in text_units for c in units))
+    all_chunks = dict(
+        zip(all_chunk_ids, await text_chunks_db.get_by_ids(all_chunk_ids))
+    )
+
     all_text_units_lookup = {}
 
     for index, unit_list in enumerate(text_units):
         for c_id in unit_list:
             if c_id not in all_text_units_lookup:
                 all_text_units_lookup[c_id] = {
-                    "data": await text_chunks_db.get_by_id(c_id),
+                    "data": all_chunks[c_id],
                     "order": index,
                 }
 
@@ -903,39 +1276,20 @@ async def hybrid_query(
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     query_param: QueryParam,
     global_config: dict,
+    semantic_cache: SemanticLLMCache = None,
 ) -> str:
+    cached_response = await _lookup_answer(query, query_param, semantic_cache)
+    if cached_response is not None:
+        return cached_response
     low_level_context = None
     high_level_context = None
     use_model_func = global_config["llm_model_func"]
 
-    kw_prompt_temp = PROMPTS["keywords_extraction"]
-    kw_prompt = kw_prompt_temp.format(query=query)
-
-    result = await use_model_func(kw_prompt)
-    try:
-        keywords_data = json.loads(result)
-        hl_keywords = keywords_data.get("high_level_keywords", [])
-        ll_keywords = keywords_data.get("low_level_keywords", [])
-        hl_keywords = ", ".join(hl_keywords)
-        ll_keywords = ", ".join(ll_keywords)
-    except json.JSONDecodeError:
-        try:
-            result = (
-                result.replace(kw_prompt[:-1], "")
-                .replace("user", "")
-                .replace("model", "")
-                .strip()
-            )
-            result = "{" + result.split("{")[1].split("}")[0] + "}"
-            keywords_data = json.loads(result)
-            hl_keywords = keywords_data.get("high_level_keywords", [])
-            ll_keywords = keywords_data.get("low_level_keywords", [])
-            hl_keywords = ", ".join(hl_keywords)
-            ll_keywords = ", ".join(ll_keywords)
-        # Handle parsing error
-        except json.JSONDecodeError as e:
-            print(f"JSON parsing error: {e}")
-            return PROMPTS["fail_response"]
+    keywords_data = await _extract_keywords(query, use_model_func, semantic_cache)
+    if keywords_data is None:
+        return PROMPTS["fail_response"]
+    hl_keywords = ", ".join(keywords_data.get("high_level_keywords", []))
+    ll_keywords = ", ".join(keywords_data.get("low_level_keywords", []))
 
     if ll_keywords:
         low_level_context = await _build_local_query_context(
@@ -946,7 +1300,6 @@ async def hybrid_query(
             query_param,
         )
 
-
     if hl_keywords:
         high_level_context = await _build_global_query_context(
             hl_keywords,
@@ -957,33 +1310,9 @@ async def hybrid_query(
             query_param,
         )
 
-
     context = combine_contexts(high_level_context, low_level_context)
-    # print(context)
-    if query_param.only_need_context:
-        return context
-    if context is None:
-        return PROMPTS["fail_response"]
-
-    sys_prompt_temp = PROMPTS["rag_response"]
-    sys_prompt = sys_prompt_temp.format(
-        context_data=context, response_type=query_param.response_type
-    )
-    response = await use_model_func(
-        query,
-        system_prompt=sys_prompt,
-    )
-    if len(response) > len(sys_prompt):
-        response = (
-            response.replace(sys_prompt, "")
-            .replace("user", "")
-            .replace("model", "")
-            .replace(query, "")
-            .replace("<system>", "")
-            .replace("</system>", "")
-            .strip()
-        )
-    return response
+    response = await _respond_with_context(query, context, query_param, use_model_func)
+    return await _store_answer(query, query_param, semantic_cache, response)
 
 
 def combine_contexts(high_level_context, low_level_context):
@@ -1056,9 +1385,18 @@ async def naive_query(
     text_chunks_db: BaseKVStorage[TextChunkSchema],
     query_param: QueryParam,
     global_config: dict,
+    vdb_results: list[dict] = None,
+    semantic_cache: SemanticLLMCache = None,
 ):
+    cached_response = await _lookup_answer(query, query_param, semantic_cache)
+    if cached_response is not None:
+        return cached_response
     use_model_func = global_config["llm_model_func"]
-    results = await chunks_vdb.query(query, top_k=query_param.top_k)
+    results = (
+        vdb_results
+        if vdb_results is not None
+        else await chunks_vdb.query(query, top_k=query_param.top_k)
+    )
     if not len(results):
         return PROMPTS["fail_response"]
     chunks_ids = [r["id"] for r in results]
@@ -1096,4 +1434,149 @@ async def naive_query(
             .strip()
         )
 
-    return response
\ No newline at end of file
+    return await _store_answer(query, query_param, semantic_cache, response)
+
+
+async def batch_query(
+    queries: list[str],
+    knowledge_graph_inst: BaseGraphStorage,
+    entities_vdb: BaseVectorStorage,
+    relationships_vdb: BaseVectorStorage,
+    chunks_vdb: BaseVectorStorage,
+    text_chunks_db: BaseKVStorage[TextChunkSchema],
+    query_param: QueryParam,
+    global_config: dict,
+    semantic_cache: SemanticLLMCache = None,
+) -> list[str]:
+    """Answer many queries with one vector search per vector DB for the whole batch.
+
+    Keyword extraction and answer generation still run per query, concurrently.
+    Queries answered by the semantic cache skip both.
+    """
+    answers = [None] * len(queries)
+    if semantic_cache is not None and not query_param.only_need_context:
+        answers = await semantic_cache.lookup_many(_answer_tier(query_param), queries)
+    missed = [i for i, answer in enumerate(answers) if answer is None]
+    if not missed:
+        return answers
+    missed_answers = await _batch_answer(
+        [queries[i] for i in missed],
+        knowledge_graph_inst,
+        entities_vdb,
+        relationships_vdb,
+        chunks_vdb,
+        text_chunks_db,
+        query_param,
+        global_config,
+        semantic_cache,
+    )
+    for i, answer in zip(missed, missed_answers):
+        answers[i] = await _store_answer(
+            queries[i], query_param, semantic_cache, answer
+        )
+    return answers
+
+
+async def _batch_answer(
+    queries: list[str],
+    knowledge_graph_inst: BaseGraphStorage,
+    entities_vdb: BaseVectorStorage,
+    relationships_vdb: BaseVectorStorage,
+    chunks_vdb: BaseVectorStorage,
+    text_chunks_db: BaseKVStorage[TextChunkSchema],
+    query_param: QueryParam,
+    global_config: dict,
+    semantic_cache: SemanticLLMCache,
+) -> list[str]:
+    use_model_func = global_config["llm_model_func"]
+    mode = query_param.mode
+    if mode == "naive":
+        all_results = await chunks_vdb.query_batch(queries, top_k=query_param.top_k)
+        return await asyncio.gather(
+            *[
+                naive_query(
+                    query,
+                    chunks_vdb,
+                    text_chunks_db,
+                    query_param,
+                    global_config,
+                    vdb_results=results,
+                )
+                for query, results in zip(queries, all_results)
+            ]
+        )
+    if mode not in ("local", "global", "hybrid"):
+        raise ValueError(f"Unknown mode {mode}")
+
+    all_keywords_data = await asyncio.gather(
+        *[
+            _extract_keywords(query, use_model_func, semantic_cache)
+            for query in queries
+        ]
+    )
+    ll_keywords = [
+        ", ".join(k.get("low_level_keywords", [])) if k is not None else ""
+        for k in all_keywords_data
+    ]
+    hl_keywords = [
+        ", ".join(k.get("high_level_keywords", [])) if k is not None else ""
+        for k in all_keywords_data
+    ]
+    entity_results = (
+        await _query_batch_skip_empty(entities_vdb, ll_keywords, query_param.top_k)
+        if mode in ("local", "hybrid")
+        else [None] * len(queries)
+    )
+    relation_results = (
+        await _query_batch_skip_empty(relationships_vdb, hl_keywords, query_param.top_k)
+        if mode in ("global", "hybrid")
+        else [None] * len(queries)
+    )
+
+    async def _answer(index: int) -> str:
+        if all_keywords_data[index] is None:
+            return PROMPTS["fail_response"]
+        low_level_context = None
+        high_level_context = None
+        if entity_results[index] is not None:
+            low_level_context = await _build_local_query_context(
+                ll_keywords[index],
+                knowledge_graph_inst,
+                entities_vdb,
+                text_chunks_db,
+                query_param,
+                vdb_results=entity_results[index],
+            )
+        if relation_results[index] is not None:
+            high_level_context = await _build_global_query_context(
+                hl_keywords[index],
+                knowledge_graph_inst,
+                entities_vdb,
+                relationships_vdb,
+                text_chunks_db,
+                query_param,
+                vdb_results=relation_results[index],
+            )
+        if mode == "hybrid":
+            context = combine_contexts(high_level_context, low_level_context)
+        else:
+            context = low_level_context if mode == "local" else high_level_context
+        return await _respond_with_context(
+            queries[index], context, query_param, use_model_func
+        )
+
+    return await asyncio.gather(*[_answer(i) for i in range(len(queries))])
+
+
+async def _query_batch_skip_empty(
+    vdb: BaseVectorStorage, texts: list[str], top_k: int
+) -> list[Union[list[dict], None]]:
+    """query_batch over the non-empty texts, None in place of the empty ones"""
+    non_empty = [i for i, text in enumerate(texts) if text]
+    results = [None] * len(texts)
+    if not non_empty:
+        return results
+    batch_results = await vdb.query_batch([texts[i] for i in non_empty], top_k=top_k)
+    for i, batch_result in zip(non_empty, batch_results):
+        results[i] = batch_result
+    return results
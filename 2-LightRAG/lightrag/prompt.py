@@ -132,6 +132,22 @@ Description List: {description_list}
 Output:
 """
 
+PROMPTS[
+    "summarize_entity_descriptions_batch"
+] = """You are a helpful assistant responsible for generating comprehensive summaries of the data provided below.
+Each item below gives one or two entities, and a list of descriptions, all related to the same entity or group of entities.
+For every item, please concatenate all of its descriptions into a single, comprehensive description. Make sure to include information collected from all the descriptions of that item, and only of that item.
+If the provided descriptions are contradictory, please resolve the contradictions and provide a single, coherent summary.
+Make sure it is written in third person, and include the entity names so we the have full context.
+Answer with a JSON object mapping the id of every item to its summary, e.g. {{"0": "summary of item 0", "1": "summary of item 1"}}.
+
+#######
+-Data-
+Items: {items}
+#######
+Output:
+"""
+
 PROMPTS[
     "entiti_continue_extraction"
 ] = """MANY entities were missed in the last extraction.  Add them below using the same format:
@@ -1,17 +1,28 @@
 import asyncio
+import base64
 import html
+import json
 import os
+import pickle
+import re
+import sqlite3
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
+from functools import wraps
 from typing import Any, Union, cast
 import networkx as nx
 import numpy as np
 from nano_vectordb import NanoVectorDB
 
-from .utils import load_json, logger, write_json
+from .utils import EmbeddingFunc, compute_mdhash_id, load_json, logger, write_json
 from .base import (
     BaseGraphStorage,
     BaseKVStorage,
     BaseVectorStorage,
+    StorageNameSpace,
 )
 
 
@@ -27,7 +38,10 @@ class JsonKVStorage(BaseKVStorage):
         return list(self._data.keys())
 
     async def index_done_callback(self):
+        if not self.is_dirty:
+            return
         write_json(self._data, self._file_name)
+        self.clear_dirty()
 
     async def get_by_id(self, id):
         return self._data.get(id, None)
@@ -49,11 +63,765 @@ class JsonKVStorage(BaseKVStorage):
 
     async def upsert(self, data: dict[str, dict]):
         left_data = {k: v for k, v in data.items() if k not in self._data}
-        self._data.update(left_data)
+        if left_data:
+            self._data.update(left_data)
+            self.mark_dirty()
         return left_data
 
     async def drop(self):
         self._data = {}
+        self.mark_dirty()
+
+
+@dataclass
+class AppendLogKVStorage(BaseKVStorage):
+    """Log-structured alternative to JsonKVStorage.
+
+    Every flush appends only the keys upserted since the previous flush to
+    ``kv_store_{namespace}.log`` (one JSON record per line), and an in-memory
+    ``key -> (offset, length)`` index points at the record of each key. Like
+    JsonKVStorage, upsert only inserts new keys, so every record stays live.
+    """
+
+    def __post_init__(self):
+        working_dir = self.global_config["working_dir"]
+        self._file_name = os.path.join(working_dir, f"kv_store_{self.namespace}.log")
+        self._index: dict[str, tuple[int, int]] = {}
+        self._pending: dict[str, dict] = {}
+        self._log_bytes = 0
+        self._lock = asyncio.Lock()
+        self._load_log()
+        self._reader = open(self._file_name, "rb")
+
+        legacy_file_name = os.path.join(working_dir, f"kv_store_{self.namespace}.json")
+        if not self._index and os.path.exists(legacy_file_name):
+            # picked up by the first flush, the JSON file is left untouched
+            self._pending = load_json(legacy_file_name) or {}
+            self.mark_dirty()
+            logger.info(
+                f"Migrating {len(self._pending)} records from {legacy_file_name}"
+            )
+        logger.info(
+            f"Load KV {self.namespace} with {len(self._index) + len(self._pending)} data"
+        )
+
+    def _load_log(self):
+        if not os.path.exists(self._file_name):
+            open(self._file_name, "wb").close()
+            return
+        offset = 0
+        with open(self._file_name, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                self._index[record["k"]] = (offset, len(line))
+                offset += len(line)
+        if offset != os.path.getsize(self._file_name):
+            logger.warning(
+                f"Truncating torn tail of {self._file_name} at byte {offset}"
+            )
+            with open(self._file_name, "r+b") as f:
+                f.truncate(offset)
+        self._log_bytes = offset
+
+    def _read_value(self, key: str):
+        offset, length = self._index[key]
+        self._reader.seek(offset)
+        return json.loads(self._reader.read(length))["v"]
+
+    def _get(self, key: str):
+        if key in self._pending:
+            return self._pending[key]
+        if key in self._index:
+            return self._read_value(key)
+        return None
+
+    async def all_keys(self) -> list[str]:
+        return list(self._index.keys() | self._pending.keys())
+
+    async def get_by_id(self, id):
+        return self._get(id)
+
+    async def get_by_ids(self, ids, fields=None):
+        values = [self._get(id) for id in ids]
+        if fields is None:
+            return values
+        return [
+            {k: v for k, v in value.items() if k in fields} if value else None
+            for value in values
+        ]
+
+    async def filter_keys(self, data: list[str]) -> set[str]:
+        return set([s for s in data if s not in self._index and s not in self._pending])
+
+    async def upsert(self, data: dict[str, dict]):
+        left_data = {
+            k: v
+            for k, v in data.items()
+            if k not in self._index and k not in self._pending
+        }
+        if left_data:
+            self._pending.update(left_data)
+            self.mark_dirty()
+        return left_data
+
+    async def index_done_callback(self):
+        if not self.is_dirty:
+            return
+        async with self._lock:
+            pending, self._pending = self._pending, {}
+            self.clear_dirty()
+            offset = self._log_bytes
+            index = {}
+            try:
+                with open(self._file_name, "ab") as f:
+                    for key, value in pending.items():
+                        line = (
+                            json.dumps({"k": key, "v": value}, ensure_ascii=False)
+                            + "\n"
+                        ).encode("utf-8")
+                        f.write(line)
+                        index[key] = (offset, len(line))
+                        offset += len(line)
+            except BaseException:
+                # cut any partial write and keep the records for the next flush
+                with open(self._file_name, "r+b") as f:
+                    f.truncate(self._log_bytes)
+                self._pending = {**pending, **self._pending}
+                self.mark_dirty()
+                raise
+            self._index.update(index)
+            self._log_bytes = offset
+        logger.debug(f"Appended {len(pending)} records to {self._file_name}")
+
+    async def drop(self):
+        async with self._lock:
+            self._pending = {}
+            self.clear_dirty()
+            self._index = {}
+            self._log_bytes = 0
+            open(self._file_name, "wb").close()
+            self._reader.close()
+            self._reader = open(self._file_name, "rb")
+
+
+@dataclass
+class ShardedJsonKVStorage(BaseKVStorage):
+    """JsonKVStorage split into hash-partitioned shard files.
+
+    Records live in ``kv_store_{namespace}/shard_XXXX.json``, picked by the
+    CRC32 of the key, and ``manifest.json`` holds the shard count and the key
+    set. Shards are read on first access and at most ``max_resident_shards``
+    stay in memory, least recently used ones are written back and evicted.
+    """
+
+    def __post_init__(self):
+        working_dir = self.global_config["working_dir"]
+        storage_kwargs = self.global_config.get(
+            "key_string_value_json_storage_cls_kwargs", {}
+        )
+        self._max_resident_shards = storage_kwargs.get("max_resident_shards", 16)
+        self._dir_name = os.path.join(working_dir, f"kv_store_{self.namespace}")
+        self._manifest_file_name = os.path.join(self._dir_name, "manifest.json")
+        os.makedirs(self._dir_name, exist_ok=True)
+        manifest = load_json(self._manifest_file_name)
+        if manifest is None:
+            self._num_shards = storage_kwargs.get("num_shards", 64)
+            self._keys = set()
+        else:
+            self._num_shards = manifest["num_shards"]
+            self._keys = set(manifest["keys"])
+        self._shards: OrderedDict[int, dict] = OrderedDict()
+        self._dirty_shards: set[int] = set()
+
+        legacy_file_name = os.path.join(working_dir, f"kv_store_{self.namespace}.json")
+        if manifest is None and os.path.exists(legacy_file_name):
+            self._migrate(load_json(legacy_file_name) or {})
+            logger.info(f"Migrated {len(self._keys)} records from {legacy_file_name}")
+        logger.info(
+            f"Load KV {self.namespace} with {len(self._keys)} data in {self._num_shards} shards"
+        )
+
+    def _shard_of(self, key: str) -> int:
+        return zlib.crc32(key.encode("utf-8")) % self._num_shards
+
+    def _shard_file_name(self, shard: int) -> str:
+        return os.path.join(self._dir_name, f"shard_{shard:04d}.json")
+
+    def _write_shard(self, shard: int):
+        write_json(self._shards[shard], self._shard_file_name(shard))
+        self._dirty_shards.discard(shard)
+
+    def _write_manifest(self):
+        write_json(
+            {"num_shards": self._num_shards, "keys": list(self._keys)},
+            self._manifest_file_name,
+        )
+
+    def _migrate(self, data: dict[str, dict]):
+        """Write a monolithic JSON store out as shards, the JSON file is kept"""
+        shards = [{} for _ in range(self._num_shards)]
+        for key, value in data.items():
+            shards[self._shard_of(key)][key] = value
+        for shard, shard_data in enumerate(shards):
+            if shard_data:
+                write_json(shard_data, self._shard_file_name(shard))
+        self._keys = set(data)
+        self._write_manifest()
+
+    def _shard(self, shard: int) -> dict:
+        if shard in self._shards:
+            self._shards.move_to_end(shard)
+            return self._shards[shard]
+        self._shards[shard] = load_json(self._shard_file_name(shard)) or {}
+        while len(self._shards) > self._max_resident_shards:
+            evicted = next(iter(self._shards))
+            if evicted in self._dirty_shards:
+                self._write_shard(evicted)
+            del self._shards[evicted]
+        return self._shards[shard]
+
+    async def all_keys(self) -> list[str]:
+        return list(self._keys)
+
+    async def index_done_callback(self):
+        if not self.is_dirty:
+            return
+        for shard in list(self._dirty_shards):
+            self._write_shard(shard)
+        self._write_manifest()
+        self.clear_dirty()
+
+    async def get_by_id(self, id):
+        if id not in self._keys:
+            return None
+        return self._shard(self._shard_of(id)).get(id)
+
+    async def get_by_ids(self, ids, fields=None):
+        # group the lookups so every shard is loaded at most once
+        by_shard: dict[int, list[int]] = {}
+        for i, id in enumerate(ids):
+            if id in self._keys:
+                by_shard.setdefault(self._shard_of(id), []).append(i)
+        values = [None] * len(ids)
+        for shard, positions in by_shard.items():
+            shard_data = self._shard(shard)
+            for i in positions:
+                values[i] = shard_data.get(ids[i])
+        if fields is None:
+            return values
+        return [
+            {k: v for k, v in value.items() if k in fields} if value else None
+            for value in values
+        ]
+
+    async def filter_keys(self, data: list[str]) -> set[str]:
+        return set([s for s in data if s not in self._keys])
+
+    async def upsert(self, data: dict[str, dict]):
+        left_data = {k: v for k, v in data.items() if k not in self._keys}
+        by_shard: dict[int, dict] = {}
+        for key, value in left_data.items():
+            by_shard.setdefault(self._shard_of(key), {})[key] = value
+        for shard, shard_data in by_shard.items():
+            self._shard(shard).update(shard_data)
+            self._dirty_shards.add(shard)
+            self._keys.update(shard_data)
+        if left_data:
+            self.mark_dirty()
+        return left_data
+
+    async def drop(self):
+        self._keys = set()
+        self._shards = OrderedDict()
+        self._dirty_shards = set()
+        for shard in range(self._num_shards):
+            if os.path.exists(self._shard_file_name(shard)):
+                os.remove(self._shard_file_name(shard))
+        self.mark_dirty()
+
+
+@dataclass
+class SQLiteKVStorage(BaseKVStorage):
+    """KV storage in a SQLite database shared by all namespaces.
+
+    Every namespace is a table in ``kv_store.sqlite`` opened in WAL mode, so
+    query processes can keep reading while the indexer writes. Statements run
+    on a single worker thread owned by the storage, off the event loop, and
+    every upsert commits on its own so writers never hold the lock between
+    calls.
+    """
+
+    _max_variables = 500
+
+    def __post_init__(self):
+        storage_kwargs = self.global_config.get(
+            "key_string_value_json_storage_cls_kwargs", {}
+        )
+        self._file_name = os.path.join(
+            self.global_config["working_dir"],
+            storage_kwargs.get("sqlite_file_name", "kv_store.sqlite"),
+        )
+        self._table = f'"kv_{self.namespace}"'
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._conn = sqlite3.connect(
+            self._file_name,
+            timeout=storage_kwargs.get("sqlite_timeout", 30.0),
+            check_same_thread=False,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {self._table} "
+                "(key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+        (count,) = self._conn.execute(f"SELECT COUNT(*) FROM {self._table}").fetchone()
+        logger.info(f"Load KV {self.namespace} with {count} data")
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, func, *args
+        )
+
+    def _chunks(self, keys: list[str]):
+        for i in range(0, len(keys), self._max_variables):
+            yield keys[i : i + self._max_variables]
+
+    def _existing_keys(self, keys: list[str]) -> set[str]:
+        existing = set()
+        for chunk in self._chunks(keys):
+            placeholders = ",".join("?" * len(chunk))
+            existing.update(
+                row[0]
+                for row in self._conn.execute(
+                    f"SELECT key FROM {self._table} WHERE key IN ({placeholders})",
+                    chunk,
+                )
+            )
+        return existing
+
+    def _select(self, keys: list[str]) -> dict[str, dict]:
+        values = {}
+        for chunk in self._chunks(keys):
+            placeholders = ",".join("?" * len(chunk))
+            values.update(
+                (key, json.loads(value))
+                for key, value in self._conn.execute(
+                    f"SELECT key, value FROM {self._table} WHERE key IN ({placeholders})",
+                    chunk,
+                )
+            )
+        return values
+
+    def _insert(self, data: dict[str, dict]) -> dict[str, dict]:
+        with self._conn:
+            existing = self._existing_keys(list(data))
+            left_data = {k: v for k, v in data.items() if k not in existing}
+            self._conn.executemany(
+                f"INSERT OR IGNORE INTO {self._table} (key, value) VALUES (?, ?)",
+                [(k, json.dumps(v, ensure_ascii=False)) for k, v in left_data.items()],
+            )
+        return left_data
+
+    async def all_keys(self) -> list[str]:
+        def _all_keys():
+            return [
+                row[0] for row in self._conn.execute(f"SELECT key FROM {self._table}")
+            ]
+
+        return await self._run(_all_keys)
+
+    async def get_by_id(self, id):
+        return (await self._run(self._select, [id])).get(id)
+
+    async def get_by_ids(self, ids, fields=None):
+        found = await self._run(self._select, list(dict.fromkeys(ids)))
+        values = [found.get(id) for id in ids]
+        if fields is None:
+            return values
+        return [
+            {k: v for k, v in value.items() if k in fields} if value else None
+            for value in values
+        ]
+
+    async def filter_keys(self, data: list[str]) -> set[str]:
+        existing = await self._run(self._existing_keys, list(dict.fromkeys(data)))
+        return set([s for s in data if s not in existing])
+
+    async def upsert(self, data: dict[str, dict]):
+        if not data:
+            return {}
+        return await self._run(self._insert, data)
+
+    async def drop(self):
+        def _drop():
+            with self._conn:
+                self._conn.execute(f"DELETE FROM {self._table}")
+
+        await self._run(_drop)
+
+
+async def _embed_in_batches(
+    embedding_func: EmbeddingFunc, contents: list[str], batch_size: int
+) -> np.ndarray:
+    batches = [
+        contents[i : i + batch_size] for i in range(0, len(contents), batch_size)
+    ]
+    embeddings_list = await asyncio.gather(
+        *[embedding_func(batch) for batch in batches]
+    )
+    return np.concatenate(embeddings_list)
+
+
+@dataclass
+class LLMResponseCacheStorage(BaseKVStorage):
+    """Bounded LLM response cache, a drop-in ``hashing_kv`` for the ``*_if_cache``
+    functions.
+
+    Responses are kept per model in ``kv_store_{namespace}/{model}.jsonl``, one
+    record per line. A flush appends the new responses to their model's file and
+    only rewrites the files of models that lost entries. Tuned through
+    ``llm_response_cache_storage_cls_kwargs``: beyond ``max_entries`` or
+    ``max_bytes`` the least recently ("lru") or least frequently ("lfu") used
+    entries are evicted down to 90% of the budget, and entries older than
+    ``ttl_seconds`` count as misses and are dropped.
+    """
+
+    def __post_init__(self):
+        working_dir = self.global_config["working_dir"]
+        storage_kwargs = self.global_config.get(
+            "llm_response_cache_storage_cls_kwargs", {}
+        )
+        self._eviction_policy = storage_kwargs.get("eviction_policy", "lru")
+        if self._eviction_policy not in ("lru", "lfu"):
+            raise ValueError(f"Unknown eviction policy {self._eviction_policy}")
+        self._max_entries = storage_kwargs.get("max_entries", 100_000)
+        self._max_bytes = storage_kwargs.get("max_bytes", 256 * 1024 * 1024)
+        self._ttl_seconds = storage_kwargs.get("ttl_seconds", None)
+        self._dir_name = os.path.join(working_dir, f"kv_store_{self.namespace}")
+        os.makedirs(self._dir_name, exist_ok=True)
+        # key -> [value, created, accessed, hits, size], least recently used first
+        self._entries: OrderedDict[str, list] = OrderedDict()
+        self._bytes = 0
+        # keys added since the last flush, and models whose file must be rewritten
+        self._appended: dict[str, list[str]] = {}
+        self._rewrite_models: set[str] = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._load()
+        logger.info(
+            f"Load LLM cache {self.namespace} with {len(self._entries)} data, {self._bytes} bytes"
+        )
+
+    def _load(self):
+        entries = []
+        for file_name in os.listdir(self._dir_name):
+            if file_name.endswith(".jsonl"):
+                entries.extend(self._read_model_file(file_name))
+        legacy_file_name = os.path.join(
+            self.global_config["working_dir"], f"kv_store_{self.namespace}.json"
+        )
+        migrating = not entries and os.path.exists(legacy_file_name)
+        if migrating:
+            # written out per model by the first flush, the JSON file is left untouched
+            now = time.time()
+            entries = [
+                (key, [value, now, now, 0])
+                for key, value in (load_json(legacy_file_name) or {}).items()
+            ]
+            logger.info(f"Migrating {len(entries)} records from {legacy_file_name}")
+        entries.sort(key=lambda item: item[1][2])
+        for key, (value, created, accessed, hits) in entries:
+            self._add(key, value, created, accessed, hits, loaded=True)
+            if migrating:
+                self._rewrite_models.add(self._model_of(value))
+        self._purge_expired()
+        self._evict()
+        if self._appended or self._rewrite_models:
+            self.mark_dirty()
+
+    def _read_model_file(self, file_name: str) -> list:
+        file_name = os.path.join(self._dir_name, file_name)
+        entries = []
+        with open(file_name, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Dropping a torn record from {file_name}")
+                    # rewritten on the next flush, so appends never follow the torn line
+                    if entries:
+                        self._rewrite_models.add(self._model_of(entries[0][1][0]))
+                    else:
+                        os.remove(file_name)
+                    break
+                entries.append((record["k"], record["v"]))
+        return entries
+
+    def _model_file_name(self, model: str) -> str:
+        slug = re.sub(r"[^\w.-]", "_", model)[:64]
+        return os.path.join(
+            self._dir_name, f"{slug}-{compute_mdhash_id(model)[:8]}.jsonl"
+        )
+
+    @staticmethod
+    def _model_of(value) -> str:
+        model = value.get("model") if isinstance(value, dict) else None
+        return model or "default"
+
+    def _add(
+        self,
+        key: str,
+        value,
+        created: float,
+        accessed: float,
+        hits: int,
+        loaded: bool = False,
+    ):
+        size = len(json.dumps(value, ensure_ascii=False))
+        self._entries[key] = [value, created, accessed, hits, size]
+        self._bytes += size
+        model = self._model_of(value)
+        if not loaded and model not in self._rewrite_models:
+            self._appended.setdefault(model, []).append(key)
+
+    def _remove(self, key: str):
+        value, _, _, _, size = self._entries.pop(key)
+        self._bytes -= size
+        model = self._model_of(value)
+        self._appended.pop(model, None)
+        self._rewrite_models.add(model)
+
+    def _expired(self, entry: list, now: float) -> bool:
+        return self._ttl_seconds is not None and now - entry[1] > self._ttl_seconds
+
+    def _purge_expired(self):
+        if self._ttl_seconds is None:
+            return
+        now = time.time()
+        for key in [
+            k for k, entry in self._entries.items() if self._expired(entry, now)
+        ]:
+            self._remove(key)
+            self.expirations += 1
+
+    def _over_budget(self, scale: float = 1.0) -> bool:
+        return (
+            self._max_entries is not None
+            and len(self._entries) > self._max_entries * scale
+        ) or (self._max_bytes is not None and self._bytes > self._max_bytes * scale)
+
+    def _evict(self):
+        if not self._over_budget():
+            return
+        # evicting a tenth at once keeps the lfu sort off the per-insert path
+        if self._eviction_policy == "lru":
+            victims = list(self._entries)
+        else:
+            victims = sorted(
+                self._entries, key=lambda k: (self._entries[k][3], self._entries[k][2])
+            )
+        for key in victims:
+            if not self._over_budget(0.9):
+                break
+            self._remove(key)
+            self.evictions += 1
+
+    def _get(self, key: str, now: float):
+        entry = self._entries.get(key)
+        if entry is not None and self._expired(entry, now):
+            self._remove(key)
+            self.expirations += 1
+            self.mark_dirty()
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        entry[2] = now
+        entry[3] += 1
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    async def all_keys(self) -> list[str]:
+        return list(self._entries.keys())
+
+    async def get_by_id(self, id):
+        return self._get(id, time.time())
+
+    async def get_by_ids(self, ids, fields=None):
+        now = time.time()
+        values = [self._get(id, now) for id in ids]
+        if fields is None:
+            return values
+        return [
+            {k: v for k, v in value.items() if k in fields} if value else None
+            for value in values
+        ]
+
+    async def filter_keys(self, data: list[str]) -> set[str]:
+        return set([s for s in data if s not in self._entries])
+
+    async def upsert(self, data: dict[str, dict]):
+        left_data = {k: v for k, v in data.items() if k not in self._entries}
+        if left_data:
+            now = time.time()
+            for key, value in left_data.items():
+                self._add(key, value, now, now, 0)
+            self._evict()
+            self.mark_dirty()
+        return left_data
+
+    @staticmethod
+    def _record_line(key: str, entry: list) -> str:
+        value, created, accessed, hits, _ = entry
+        record = {"k": key, "v": [value, created, accessed, hits]}
+        return json.dumps(record, ensure_ascii=False) + "\n"
+
+    async def index_done_callback(self):
+        self._purge_expired()
+        if self._appended or self._rewrite_models:
+            self.mark_dirty()
+        if not self.is_dirty:
+            return
+        rewrites = {model: [] for model in self._rewrite_models}
+        for key, entry in self._entries.items():
+            model = self._model_of(entry[0])
+            if model in rewrites:
+                rewrites[model].append(self._record_line(key, entry))
+        for model, lines in rewrites.items():
+            file_name = self._model_file_name(model)
+            if not lines:
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+                continue
+            tmp_file_name = file_name + ".tmp"
+            with open(tmp_file_name, "w", encoding="utf-8") as f:
+                f.writelines(lines)
+            os.replace(tmp_file_name, file_name)
+        appended = 0
+        for model, keys in self._appended.items():
+            lines = [
+                self._record_line(key, self._entries[key])
+                for key in keys
+                if key in self._entries
+            ]
+            with open(self._model_file_name(model), "a", encoding="utf-8") as f:
+                f.writelines(lines)
+            appended += len(lines)
+        logger.debug(
+            f"LLM cache {self.namespace}: appended {appended} records, "
+            f"rewrote {len(rewrites)} models, {self.stats()}"
+        )
+        self._appended = {}
+        self._rewrite_models = set()
+        self.clear_dirty()
+
+    async def drop(self):
+        for key in list(self._entries):
+            self._remove(key)
+        self.mark_dirty()
+
+
+def _normalize_rows(embeddings: np.ndarray) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=-1, keepdims=True)
+
+
+def _search_matrix(
+    matrix: np.ndarray,
+    queries: np.ndarray,
+    top_k: int,
+    better_than_threshold: float,
+    block_size: int = 256,
+) -> list[list[tuple[int, float]]]:
+    """Cosine top-k of every row of ``queries`` against the rows of ``matrix``.
+
+    Both sides must already be normalized. Queries are scored in blocks so the
+    score matrix stays bounded, and each row is cut with ``argpartition``
+    instead of a full sort. Returns ``(row, score)`` pairs, best first.
+    """
+    if matrix.shape[0] == 0:
+        return [[] for _ in range(len(queries))]
+    top_k = min(top_k, matrix.shape[0])
+    results = []
+    for start in range(0, len(queries), block_size):
+        scores = queries[start : start + block_size] @ matrix.T
+        top_index = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+        top_scores = np.take_along_axis(scores, top_index, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top_index = np.take_along_axis(top_index, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        for index_row, score_row in zip(top_index, top_scores):
+            results.append(
+                [
+                    (int(i), float(score))
+                    for i, score in zip(index_row, score_row)
+                    if score >= better_than_threshold
+                ]
+            )
+    return results
+
+
+def _quantize_rows(
+    embeddings: np.ndarray, quantization: str
+) -> tuple[np.ndarray, Union[np.ndarray, None]]:
+    """Compress normalized rows to float16, or to int8 with one scale per row"""
+    if quantization == "float16":
+        return embeddings.astype(np.float16), None
+    scales = np.abs(embeddings).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.rint(embeddings / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def _search_quantized(
+    codes: np.ndarray,
+    scales: Union[np.ndarray, None],
+    queries: np.ndarray,
+    candidates: int,
+    block_bytes: int = 4 * 1024 * 1024,
+) -> np.ndarray:
+    """Approximate top ``candidates`` rows of every query, unsorted.
+
+    The quantized matrix is decoded into float32 blocks of about
+    ``block_bytes``, a few thousand rows at typical dimensions, so scoring
+    keeps close to the memory footprint of the codes themselves.
+    """
+    candidates = min(candidates, codes.shape[0])
+    row_block = max(1, block_bytes // (codes.shape[1] * 4))
+    best_rows = np.empty((len(queries), 0), dtype=np.int64)
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+    for start in range(0, codes.shape[0], row_block):
+        block = codes[start : start + row_block].astype(np.float32)
+        scores = queries @ block.T
+        if scales is not None:
+            scores *= scales[start : start + row_block]
+        rows = np.broadcast_to(np.arange(start, start + len(block)), scores.shape)
+        best_rows = np.concatenate([best_rows, rows], axis=1)
+        best_scores = np.concatenate([best_scores, scores], axis=1)
+        if best_scores.shape[1] > candidates:
+            keep = np.argpartition(-best_scores, candidates - 1, axis=1)[:, :candidates]
+            best_rows = np.take_along_axis(best_rows, keep, axis=1)
+            best_scores = np.take_along_axis(best_scores, keep, axis=1)
+    return best_rows
 
 
 @dataclass
@@ -65,6 +833,9 @@ class NanoVectorDBStorage(BaseVectorStorage):
             self.global_config["working_dir"], f"vdb_{self.namespace}.json"
         )
         self._max_batch_size = self.global_config["embedding_batch_num"]
+        self._max_window_batches = self.global_config.get(
+            "embedding_func_max_async", 16
+        )
         self._client = NanoVectorDB(
             self.embedding_func.embedding_dim, storage_file=self._client_file_name
         )
@@ -73,30 +844,57 @@ class NanoVectorDBStorage(BaseVectorStorage):
         )
 
     async def upsert(self, data: dict[str, dict]):
+        """Embed and insert ``data`` window by window.
+
+        Each window is ``embedding_func_max_async`` batches, embedded
+        concurrently and written straight into a copy of the matrix grown once
+        up front for the new ids. Besides the old and grown matrices only a
+        window of raw embeddings is alive at a time, and the copy replaces the
+        matrix only once every window is embedded.
+        """
         logger.info(f"Inserting {len(data)} vectors to {self.namespace}")
         if not len(data):
             logger.warning("You insert an empty data to vector DB")
             return []
-        list_data = [
-            {
-                "__id__": k,
-                **{k1: v1 for k1, v1 in v.items() if k1 in self.meta_fields},
-            }
-            for k, v in data.items()
-        ]
-        contents = [v["content"] for v in data.values()]
-        batches = [
-            contents[i : i + self._max_batch_size]
-            for i in range(0, len(contents), self._max_batch_size)
-        ]
-        embeddings_list = await asyncio.gather(
-            *[self.embedding_func(batch) for batch in batches]
+        storage = self._client_storage
+        row_of = {d["__id__"]: i for i, d in enumerate(storage["data"])}
+        keys = list(data.keys())
+        updated_keys = [k for k in keys if k in row_of]
+        new_keys = [k for k in keys if k not in row_of]
+        for i, key in enumerate(new_keys):
+            row_of[key] = len(storage["data"]) + i
+        matrix = np.empty(
+            (len(row_of), self.embedding_func.embedding_dim), dtype=np.float32
         )
-        embeddings = np.concatenate(embeddings_list)
-        for i, d in enumerate(list_data):
-            d["__vector__"] = embeddings[i]
-        results = self._client.upsert(datas=list_data)
-        return results
+        matrix[: len(storage["data"])] = storage["matrix"]
+        metas: dict[str, dict] = {}
+
+        window_size = self._max_batch_size * self._max_window_batches
+        for start in range(0, len(keys), window_size):
+            window_keys = keys[start : start + window_size]
+            embeddings = _normalize_rows(
+                await _embed_in_batches(
+                    self.embedding_func,
+                    [data[k]["content"] for k in window_keys],
+                    self._max_batch_size,
+                )
+            )
+            for key, embedding in zip(window_keys, embeddings):
+                matrix[row_of[key]] = embedding
+                metas[key] = {
+                    "__id__": key,
+                    **{
+                        k1: v1 for k1, v1 in data[key].items() if k1 in self.meta_fields
+                    },
+                }
+            del embeddings
+
+        for key in updated_keys:
+            storage["data"][row_of[key]] = metas[key]
+        storage["data"].extend(metas[key] for key in new_keys)
+        storage["matrix"] = matrix
+        self.mark_dirty()
+        return {"update": updated_keys, "insert": new_keys}
 
     async def query(self, query: str, top_k=5):
         embedding = await self.embedding_func([query])
@@ -111,8 +909,797 @@ class NanoVectorDBStorage(BaseVectorStorage):
         ]
         return results
 
+    @property
+    def _client_storage(self) -> dict:
+        # nano_vectordb has no public accessor for its matrix, batched search and
+        # windowed upserts need it; the version is pinned in requirements.txt
+        return self._client._NanoVectorDB__storage
+
+    async def query_batch(self, queries: list[str], top_k=5):
+        if not queries:
+            return []
+        embeddings = _normalize_rows(
+            await _embed_in_batches(self.embedding_func, queries, self._max_batch_size)
+        )
+        storage = self._client_storage
+        all_hits = _search_matrix(
+            storage["matrix"], embeddings, top_k, self.cosine_better_than_threshold
+        )
+        return [
+            [
+                {
+                    **storage["data"][row],
+                    "__metrics__": score,
+                    "id": storage["data"][row]["__id__"],
+                    "distance": score,
+                }
+                for row, score in hits
+            ]
+            for hits in all_hits
+        ]
+
     async def index_done_callback(self):
+        if not self.is_dirty:
+            return
         self._client.save()
+        self.clear_dirty()
+
+
+@dataclass
+class MmapVectorDBStorage(BaseVectorStorage):
+    """Vector storage backed by a memory-mapped float32 matrix.
+
+    Normalized embeddings live in ``vdb_{namespace}.npy`` and are opened with
+    ``np.load(mmap_mode="r+")``, so nothing is parsed at startup and processes
+    opening the same working dir share the page cache. Ids and meta fields are
+    kept in the ``vdb_{namespace}.meta.json`` sidecar, whose row count is the
+    commit point: rows past it are ignored on load.
+
+    With ``quantization`` set to ``"float16"`` or ``"int8"`` in
+    ``vector_db_storage_cls_kwargs``, searches run on a quantized copy held in
+    memory and only the ``rescore_factor * top_k`` best candidates are scored
+    again against the float32 rows on disk.
+    """
+
+    cosine_better_than_threshold: float = 0.2
+
+    def __post_init__(self):
+        working_dir = self.global_config["working_dir"]
+        self._matrix_file_name = os.path.join(working_dir, f"vdb_{self.namespace}.npy")
+        self._meta_file_name = os.path.join(
+            working_dir, f"vdb_{self.namespace}.meta.json"
+        )
+        self._max_batch_size = self.global_config["embedding_batch_num"]
+        self.cosine_better_than_threshold = self.global_config.get(
+            "cosine_better_than_threshold", self.cosine_better_than_threshold
+        )
+        self._dim = self.embedding_func.embedding_dim
+        storage_kwargs = self.global_config.get("vector_db_storage_cls_kwargs", {})
+        self._quantization = storage_kwargs.get("quantization")
+        if self._quantization not in (None, "float16", "int8"):
+            raise ValueError(f"Quantization {self._quantization} not supported")
+        self._rescore_factor = storage_kwargs.get("rescore_factor", 4)
+
+        meta = load_json(self._meta_file_name) or {}
+        self._ids: list[str] = meta.get("ids", [])
+        self._metadata: list[dict] = meta.get("metadata", [])
+        self._row_of = {id_: row for row, id_ in enumerate(self._ids)}
+        self._matrix: np.ndarray = None
+        if self._ids:
+            assert (
+                meta["embedding_dim"] == self._dim
+            ), f"Embedding dim mismatch, expected: {self._dim}, but loaded: {meta['embedding_dim']}"
+            self._matrix = np.load(self._matrix_file_name, mmap_mode="r+")
+        self._codes: np.ndarray = None
+        self._scales: np.ndarray = None
+        if self._quantization is not None:
+            self._codes, self._scales = _quantize_rows(
+                np.empty((0, self._dim), dtype=np.float32), self._quantization
+            )
+            if self._ids:
+                self._set_codes(
+                    np.arange(len(self._ids)), self._matrix[: len(self._ids)]
+                )
+        logger.info(f"Load vdb {self.namespace} with {len(self._ids)} data")
+
+    def _set_codes(self, rows: np.ndarray, embeddings: np.ndarray):
+        """Keep the in-memory quantized copy in step with the matrix"""
+        if len(self._codes) < self._capacity:
+            self._codes = np.resize(self._codes, (self._capacity, self._dim))
+            if self._scales is not None:
+                self._scales = np.resize(self._scales, self._capacity)
+        codes, scales = _quantize_rows(
+            np.asarray(embeddings, dtype=np.float32), self._quantization
+        )
+        self._codes[rows] = codes
+        if self._scales is not None:
+            self._scales[rows] = scales
+
+    @property
+    def _capacity(self) -> int:
+        return 0 if self._matrix is None else self._matrix.shape[0]
+
+    def _reserve(self, rows: int):
+        """Grow the backing file geometrically so appends stay amortized O(1)"""
+        if rows <= self._capacity:
+            return
+        capacity = max(rows, 2 * self._capacity, 1024)
+        tmp_file_name = self._matrix_file_name + ".tmp"
+        matrix = np.lib.format.open_memmap(
+            tmp_file_name, mode="w+", dtype=np.float32, shape=(capacity, self._dim)
+        )
+        count = len(self._ids)
+        if count:
+            matrix[:count] = self._matrix[:count]
+        matrix.flush()
+        del matrix
+        os.replace(tmp_file_name, self._matrix_file_name)
+        self._matrix = np.load(self._matrix_file_name, mmap_mode="r+")
+
+    async def upsert(self, data: dict[str, dict]):
+        logger.info(f"Inserting {len(data)} vectors to {self.namespace}")
+        if not len(data):
+            logger.warning("You insert an empty data to vector DB")
+            return []
+        contents = [v["content"] for v in data.values()]
+        embeddings = _normalize_rows(
+            await _embed_in_batches(self.embedding_func, contents, self._max_batch_size)
+        )
+
+        new_ids = [k for k in data if k not in self._row_of]
+        updated_ids = [k for k in data if k in self._row_of]
+        self._reserve(len(self._ids) + len(new_ids))
+        for k in new_ids:
+            self._row_of[k] = len(self._ids)
+            self._ids.append(k)
+            self._metadata.append({})
+        rows = np.fromiter((self._row_of[k] for k in data), dtype=np.int64)
+        self._matrix[rows] = embeddings
+        if self._quantization is not None:
+            self._set_codes(rows, embeddings)
+        for row, v in zip(rows, data.values()):
+            self._metadata[row] = {
+                k1: v1 for k1, v1 in v.items() if k1 in self.meta_fields
+            }
+        self.mark_dirty()
+        return {"update": updated_ids, "insert": new_ids}
+
+    async def query(self, query: str, top_k=5):
+        return (await self.query_batch([query], top_k=top_k))[0]
+
+    async def query_batch(self, queries: list[str], top_k=5):
+        if not queries:
+            return []
+        if not self._ids:
+            return [[] for _ in queries]
+        embeddings = _normalize_rows(
+            await _embed_in_batches(self.embedding_func, queries, self._max_batch_size)
+        )
+        if self._quantization is None:
+            all_hits = _search_matrix(
+                self._matrix[: len(self._ids)],
+                embeddings,
+                top_k,
+                self.cosine_better_than_threshold,
+            )
+        else:
+            all_hits = self._search_rescored(embeddings, top_k)
+        return [
+            [
+                {**self._metadata[row], "id": self._ids[row], "distance": score}
+                for row, score in hits
+            ]
+            for hits in all_hits
+        ]
+
+    def _search_rescored(
+        self, embeddings: np.ndarray, top_k: int
+    ) -> list[list[tuple[int, float]]]:
+        count = len(self._ids)
+        candidates = _search_quantized(
+            self._codes[:count],
+            None if self._scales is None else self._scales[:count],
+            embeddings,
+            top_k * self._rescore_factor,
+        )
+        all_hits = []
+        for query, rows in zip(embeddings, candidates):
+            rows = np.sort(rows)
+            scores = self._matrix[rows] @ query
+            order = np.argsort(-scores)[:top_k]
+            all_hits.append(
+                [
+                    (int(rows[i]), float(scores[i]))
+                    for i in order
+                    if scores[i] >= self.cosine_better_than_threshold
+                ]
+            )
+        return all_hits
+
+    async def index_done_callback(self):
+        if not self.is_dirty:
+            return
+        self._matrix.flush()
+        tmp_file_name = self._meta_file_name + ".tmp"
+        with open(tmp_file_name, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "embedding_dim": self._dim,
+                    "ids": self._ids,
+                    "metadata": self._metadata,
+                },
+                f,
+                ensure_ascii=False,
+            )
+        os.replace(tmp_file_name, self._meta_file_name)
+        self.clear_dirty()
+
+
+@dataclass
+class HNSWVectorDBStorage(BaseVectorStorage):
+    """Approximate nearest neighbour storage on an hnswlib HNSW graph.
+
+    The index is persisted to ``vdb_{namespace}.hnsw`` with ids and meta fields
+    in ``vdb_{namespace}.hnsw.meta.json``; a vector's hnswlib label is its row
+    in the sidecar. Tuned through ``vector_db_storage_cls_kwargs``:
+
+    - ``M`` / ``ef_construction``: graph degree and build-time beam width
+    - ``ef_search``: query-time beam width, the recall/latency knob
+    - ``initial_capacity``: elements reserved before the first resize
+    """
+
+    cosine_better_than_threshold: float = 0.2
+
+    def __post_init__(self):
+        import hnswlib
+
+        working_dir = self.global_config["working_dir"]
+        self._index_file_name = os.path.join(working_dir, f"vdb_{self.namespace}.hnsw")
+        self._meta_file_name = os.path.join(
+            working_dir, f"vdb_{self.namespace}.hnsw.meta.json"
+        )
+        self._max_batch_size = self.global_config["embedding_batch_num"]
+        self.cosine_better_than_threshold = self.global_config.get(
+            "cosine_better_than_threshold", self.cosine_better_than_threshold
+        )
+        storage_kwargs = self.global_config.get("vector_db_storage_cls_kwargs", {})
+        self._ef_search = storage_kwargs.get("ef_search", 64)
+
+        meta = load_json(self._meta_file_name) or {}
+        self._ids: list[str] = meta.get("ids", [])
+        self._metadata: list[dict] = meta.get("metadata", [])
+        self._label_of = {id_: label for label, id_ in enumerate(self._ids)}
+        self._index = hnswlib.Index(
+            space="cosine", dim=self.embedding_func.embedding_dim
+        )
+        if self._ids:
+            self._index.load_index(self._index_file_name)
+        else:
+            self._index.init_index(
+                max_elements=storage_kwargs.get("initial_capacity", 1024),
+                M=storage_kwargs.get("M", 16),
+                ef_construction=storage_kwargs.get("ef_construction", 200),
+            )
+        logger.info(f"Load HNSW vdb {self.namespace} with {len(self._ids)} data")
+
+    async def upsert(self, data: dict[str, dict]):
+        logger.info(f"Inserting {len(data)} vectors to {self.namespace}")
+        if not len(data):
+            logger.warning("You insert an empty data to vector DB")
+            return []
+        contents = [v["content"] for v in data.values()]
+        embeddings = _normalize_rows(
+            await _embed_in_batches(self.embedding_func, contents, self._max_batch_size)
+        )
+        new_ids = [k for k in data if k not in self._label_of]
+        updated_ids = [k for k in data if k in self._label_of]
+        for k in new_ids:
+            self._label_of[k] = len(self._ids)
+            self._ids.append(k)
+            self._metadata.append({})
+        if len(self._ids) > self._index.get_max_elements():
+            self._index.resize_index(
+                max(len(self._ids), 2 * self._index.get_max_elements())
+            )
+        labels = np.fromiter((self._label_of[k] for k in data), dtype=np.int64)
+        # hnswlib re-links labels that already exist instead of duplicating them
+        self._index.add_items(embeddings, labels)
+        for label, v in zip(labels, data.values()):
+            self._metadata[label] = {
+                k1: v1 for k1, v1 in v.items() if k1 in self.meta_fields
+            }
+        self.mark_dirty()
+        return {"update": updated_ids, "insert": new_ids}
+
+    async def query(self, query: str, top_k=5):
+        return (await self.query_batch([query], top_k=top_k))[0]
+
+    async def query_batch(self, queries: list[str], top_k=5):
+        if not queries:
+            return []
+        if not self._ids:
+            return [[] for _ in queries]
+        embeddings = _normalize_rows(
+            await _embed_in_batches(self.embedding_func, queries, self._max_batch_size)
+        )
+        top_k = min(top_k, self._index.get_current_count())
+        self._index.set_ef(max(self._ef_search, top_k))
+        all_labels, all_distances = self._index.knn_query(embeddings, k=top_k)
+        results = []
+        for labels, distances in zip(all_labels, all_distances):
+            hits = []
+            for label, distance in zip(labels, distances):
+                score = 1.0 - float(distance)
+                # labels past the sidecar belong to an upsert that was never committed
+                if score < self.cosine_better_than_threshold or label >= len(self._ids):
+                    continue
+                hits.append(
+                    {**self._metadata[label], "id": self._ids[label], "distance": score}
+                )
+            results.append(hits)
+        return results
+
+    async def index_done_callback(self):
+        if not self.is_dirty:
+            return
+        self._index.save_index(self._index_file_name + ".tmp")
+        os.replace(self._index_file_name + ".tmp", self._index_file_name)
+        tmp_file_name = self._meta_file_name + ".tmp"
+        with open(tmp_file_name, "w", encoding="utf-8") as f:
+            json.dump(
+                {"ids": self._ids, "metadata": self._metadata}, f, ensure_ascii=False
+            )
+        os.replace(tmp_file_name, self._meta_file_name)
+        self.clear_dirty()
+
+
+@dataclass
+class EmbeddingCacheStorage(StorageNameSpace):
+    """Persistent cache in front of an embedding function.
+
+    Vectors are appended as raw float32 rows to ``{namespace}.f32`` and
+    ``{namespace}.index.json`` lists the key of every row, a key being the md5
+    of the model name, the embedding dimension and the text. Lookups are done
+    for a whole batch at once and only the misses reach the provider.
+    """
+
+    embedding_func: EmbeddingFunc
+    model_name: str = ""
+
+    def __post_init__(self):
+        working_dir = self.global_config["working_dir"]
+        self._vectors_file_name = os.path.join(working_dir, f"{self.namespace}.f32")
+        self._index_file_name = os.path.join(
+            working_dir, f"{self.namespace}.index.json"
+        )
+        self._dim = self.embedding_func.embedding_dim
+        if not self.model_name:
+            func = getattr(self.embedding_func, "func", self.embedding_func)
+            self.model_name = getattr(func, "__name__", "")
+        index = load_json(self._index_file_name) or {}
+        if index.get("embedding_dim", self._dim) != self._dim:
+            raise ValueError(
+                f"Embedding cache {self._index_file_name} holds {index['embedding_dim']}-d vectors, expected {self._dim}"
+            )
+        self._keys: list[str] = index.get("keys", [])
+        self._row_of = {key: row for row, key in enumerate(self._keys)}
+        self._stored_rows = len(self._keys)
+        self._pending_vectors: list[np.ndarray] = []
+        self._vectors = self._open_vectors()
+        self.hits = 0
+        self.misses = 0
+        logger.info(
+            f"Load embedding cache {self.namespace} with {self._stored_rows} vectors"
+        )
+
+    def _open_vectors(self) -> np.ndarray:
+        if not self._stored_rows:
+            return np.empty((0, self._dim), dtype=np.float32)
+        row_bytes = self._dim * np.dtype(np.float32).itemsize
+        if os.path.getsize(self._vectors_file_name) > self._stored_rows * row_bytes:
+            # rows appended by a flush that died before writing the index
+            with open(self._vectors_file_name, "r+b") as f:
+                f.truncate(self._stored_rows * row_bytes)
+        return np.memmap(
+            self._vectors_file_name,
+            dtype=np.float32,
+            mode="r",
+            shape=(self._stored_rows, self._dim),
+        )
+
+    def _key(self, text: str) -> str:
+        return compute_mdhash_id(f"{self.model_name}\0{self._dim}\0{text}")
+
+    def _row(self, row: int) -> np.ndarray:
+        if row < self._stored_rows:
+            return self._vectors[row]
+        return self._pending_vectors[row - self._stored_rows]
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    async def embed(self, texts: list[str]) -> np.ndarray:
+        keys = [self._key(text) for text in texts]
+        result = np.empty((len(texts), self._dim), dtype=np.float32)
+        misses: dict[str, list[int]] = {}
+        for i, key in enumerate(keys):
+            row = self._row_of.get(key)
+            if row is None:
+                misses.setdefault(key, []).append(i)
+            else:
+                result[i] = self._row(row)
+        missed = sum(len(positions) for positions in misses.values())
+        self.hits += len(texts) - missed
+        self.misses += missed
+        if not misses:
+            return result
+
+        miss_keys = list(misses)
+        embeddings = np.asarray(
+            await self.embedding_func([texts[misses[key][0]] for key in miss_keys]),
+            dtype=np.float32,
+        )
+        for key, embedding in zip(miss_keys, embeddings):
+            result[misses[key]] = embedding
+            # a concurrent call may have stored the same text in the meantime
+            if key not in self._row_of:
+                self._row_of[key] = len(self._keys)
+                self._keys.append(key)
+                self._pending_vectors.append(embedding)
+                self.mark_dirty()
+        return result
+
+    def cached_embedding_func(self):
+        """The embedding function with the cache in front of it. A plain
+        function rather than an EmbeddingFunc, so ``asdict`` on the owner does
+        not deep-copy the cache along with it."""
+
+        @wraps(self.embedding_func)
+        async def cached_func(texts: list[str]) -> np.ndarray:
+            return await self.embed(texts)
+
+        return cached_func
+
+    async def index_done_callback(self):
+        if not self.is_dirty or not self._pending_vectors:
+            self.clear_dirty()
+            return
+        logger.debug(
+            f"Embedding cache {self.namespace}: storing {len(self._pending_vectors)} vectors, {self.hits} hits, {self.misses} misses ({self.hit_rate:.1%} hit rate)"
+        )
+        # vectors first, so the index never points past the end of the file
+        with open(self._vectors_file_name, "ab") as f:
+            f.write(np.stack(self._pending_vectors).astype(np.float32).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        tmp_file_name = self._index_file_name + ".tmp"
+        with open(tmp_file_name, "w", encoding="utf-8") as f:
+            json.dump({"embedding_dim": self._dim, "keys": self._keys}, f)
+        os.replace(tmp_file_name, self._index_file_name)
+        self._stored_rows = len(self._keys)
+        self._pending_vectors = []
+        self._vectors = self._open_vectors()
+        self.clear_dirty()
+
+
+@dataclass
+class SemanticLLMCache(StorageNameSpace):
+    """Similarity lookup in front of the exact-match LLM response cache.
+
+    Entries are grouped in tiers, e.g. the keywords extracted from a query or
+    its answer in one mode, and a lookup returns the cached value of the most
+    similar earlier query of the tier when their cosine similarity reaches
+    ``semantic_llm_cache_threshold``. Entries are appended to
+    ``{namespace}.jsonl``, one record per line with the normalized query
+    embedding inline; the file is only rewritten when entries are dropped.
+    """
+
+    embedding_func: EmbeddingFunc
+    # query embeddings kept around for the other tiers of the same query
+    _max_query_embeddings = 1024
+
+    def __post_init__(self):
+        working_dir = self.global_config["working_dir"]
+        self._file_name = os.path.join(working_dir, f"{self.namespace}.jsonl")
+        self.similarity_threshold = self.global_config.get(
+            "semantic_llm_cache_threshold", 0.95
+        )
+        self.max_entries = self.global_config.get(
+            "semantic_llm_cache_max_entries", 10000
+        )
+        self._tiers: dict[str, dict] = {}
+        # (tier, query) stored since the last flush, or a full rewrite
+        self._appended: list[tuple[str, str]] = []
+        self._rewrite = False
+        self._load()
+        self._query_embeddings: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._stats: dict[str, dict] = {}
+        logger.info(
+            f"Load semantic cache {self.namespace} with {sum(len(t['queries']) for t in self._tiers.values())} entries"
+        )
+
+    def _load(self):
+        if not os.path.exists(self._file_name):
+            return
+        with open(self._file_name, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Dropping a torn record from {self._file_name}")
+                    self._rewrite = True
+                    break
+                if record["q"] in self._tiers.get(record["t"], {}).get("row_of", {}):
+                    # a value stored again, compacted away by a rewrite
+                    self._rewrite = True
+                embedding = np.frombuffer(
+                    base64.b64decode(record["e"]), dtype=np.float32
+                )
+                self._add(record["t"], record["q"], record["v"], embedding)
+        if self._rewrite:
+            self.mark_dirty()
+
+    def _new_tier(self) -> dict:
+        return {
+            "queries": [],
+            "returns": [],
+            "row_of": {},
+            "matrix": np.empty(
+                (16, self.embedding_func.embedding_dim), dtype=np.float32
+            ),
+        }
+
+    def _add(self, tier: str, query: str, value: Any, embedding: np.ndarray):
+        entries = self._tiers.setdefault(tier, self._new_tier())
+        row = entries["row_of"].get(query)
+        if row is not None:
+            entries["returns"][row] = value
+            return
+        size = len(entries["queries"])
+        if size == len(entries["matrix"]):
+            # grown geometrically, so storing stays amortized O(1)
+            matrix = np.empty((2 * size, entries["matrix"].shape[1]), np.float32)
+            matrix[:size] = entries["matrix"]
+            entries["matrix"] = matrix
+        entries["matrix"][size] = embedding
+        entries["row_of"][query] = size
+        entries["queries"].append(query)
+        entries["returns"].append(value)
+        if size + 1 > self.max_entries:
+            self._evict(entries)
+
+    def _evict(self, entries: dict):
+        # the oldest tenth goes at once, which keeps rewrites of the file rare
+        drop = len(entries["queries"]) - max(1, int(self.max_entries * 0.9))
+        size = len(entries["queries"]) - drop
+        matrix = np.empty_like(entries["matrix"])
+        matrix[:size] = entries["matrix"][drop : drop + size]
+        entries["matrix"] = matrix
+        entries["queries"] = entries["queries"][drop:]
+        entries["returns"] = entries["returns"][drop:]
+        entries["row_of"] = {q: i for i, q in enumerate(entries["queries"])}
+        self._rewrite = True
+
+    async def _embed(self, queries: list[str]) -> np.ndarray:
+        missing = list(
+            dict.fromkeys(q for q in queries if q not in self._query_embeddings)
+        )
+        if missing:
+            embeddings = _normalize_rows(await self.embedding_func(missing))
+            self._query_embeddings.update(zip(missing, embeddings))
+        result = np.stack([self._query_embeddings[q] for q in queries])
+        for q in queries:
+            self._query_embeddings.move_to_end(q)
+        while len(self._query_embeddings) > self._max_query_embeddings:
+            self._query_embeddings.popitem(last=False)
+        return result
+
+    async def lookup_many(self, tier: str, queries: list[str]) -> list[Any]:
+        """The cached value of every query, None where nothing is similar enough"""
+        stats = self._stats.setdefault(tier, {"hits": 0, "misses": 0})
+        if not queries:
+            return []
+        # embedded even for an empty tier, storing the answers reuses them
+        embeddings = await self._embed(queries)
+        entries = self._tiers.get(tier)
+        if entries is None or not len(entries["queries"]):
+            stats["misses"] += len(queries)
+            return [None] * len(queries)
+        similarities = embeddings @ entries["matrix"][: len(entries["queries"])].T
+        results = []
+        for i, row in enumerate(similarities.argmax(axis=1)):
+            if similarities[i, row] >= self.similarity_threshold:
+                results.append(entries["returns"][row])
+                stats["hits"] += 1
+            else:
+                results.append(None)
+                stats["misses"] += 1
+        return results
+
+    async def lookup(self, tier: str, query: str) -> Any:
+        return (await self.lookup_many(tier, [query]))[0]
+
+    async def store(self, tier: str, query: str, value: Any):
+        embedding = (await self._embed([query]))[0]
+        self._add(tier, query, value, embedding)
+        self._appended.append((tier, query))
+        self.mark_dirty()
+
+    def clear_tiers(self, prefix: str):
+        """Forget every tier whose name starts with ``prefix``"""
+        stale = [tier for tier in self._tiers if tier.startswith(prefix)]
+        for tier in stale:
+            del self._tiers[tier]
+        if stale:
+            self._rewrite = True
+            self.mark_dirty()
+
+    def stats(self) -> dict[str, dict]:
+        """hits, misses and hit rate of every tier looked up so far"""
+        return {
+            tier: {
+                **stats,
+                "hit_rate": stats["hits"] / (stats["hits"] + stats["misses"])
+                if stats["hits"] + stats["misses"]
+                else 0.0,
+                "entries": len(self._tiers.get(tier, {}).get("queries", [])),
+            }
+            for tier, stats in self._stats.items()
+        }
+
+    def _record_line(self, tier: str, query: str) -> str:
+        entries = self._tiers[tier]
+        row = entries["row_of"][query]
+        record = {
+            "t": tier,
+            "q": query,
+            "v": entries["returns"][row],
+            "e": base64.b64encode(entries["matrix"][row].tobytes()).decode("ascii"),
+        }
+        return json.dumps(record, ensure_ascii=False) + "\n"
+
+    async def index_done_callback(self):
+        for tier, stats in self.stats().items():
+            logger.debug(
+                f"Semantic cache {self.namespace} {tier}: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate)"
+            )
+        if not self.is_dirty:
+            return
+        if self._rewrite:
+            tmp_file_name = self._file_name + ".tmp"
+            with open(tmp_file_name, "w", encoding="utf-8") as f:
+                for tier, entries in self._tiers.items():
+                    f.writelines(
+                        self._record_line(tier, query) for query in entries["queries"]
+                    )
+            os.replace(tmp_file_name, self._file_name)
+        else:
+            with open(self._file_name, "a", encoding="utf-8") as f:
+                f.writelines(
+                    self._record_line(tier, query)
+                    for tier, query in self._appended
+                    if query in self._tiers.get(tier, {}).get("row_of", {})
+                )
+        self._appended = []
+        self._rewrite = False
+        self.clear_dirty()
+
+
+def _attribute_columns(items: list[dict], interned: dict) -> dict[str, list]:
+    """Turn a list of attribute dicts into one list per key, None where a key
+    is missing, with equal strings folded onto a single object."""
+    columns = {}
+    for i, attrs in enumerate(items):
+        for k, v in attrs.items():
+            if k not in columns:
+                columns[k] = [None] * len(items)
+            columns[k][i] = interned.setdefault(v, v) if isinstance(v, str) else v
+    return columns
+
+
+class FrozenGraphView:
+    """Read-only, array-backed copy of a graph for query-time lookups.
+
+    Nodes are numbered in insertion order. Adjacency is CSR: the neighbours of
+    node i are ``indices[indptr[i]:indptr[i + 1]]``, sorted so an edge is found
+    with a binary search, and ``edge_ids`` holds the edge behind each slot.
+    Node and edge attributes live in per-key columns indexed by those ids.
+    """
+
+    def __init__(self, graph: nx.Graph):
+        self.directed = graph.is_directed()
+        self.nodes = list(graph.nodes)
+        self.node_index = {node: i for i, node in enumerate(self.nodes)}
+        edges = list(graph.edges(data=True))
+        num_nodes, num_edges = len(self.nodes), len(edges)
+        interned = {}
+        self.node_attrs = _attribute_columns(
+            [graph.nodes[node] for node in self.nodes], interned
+        )
+        self.edge_attrs = _attribute_columns([data for _, _, data in edges], interned)
+
+        src = np.fromiter(
+            (self.node_index[u] for u, _, _ in edges), dtype=np.int64, count=num_edges
+        )
+        tgt = np.fromiter(
+            (self.node_index[v] for _, v, _ in edges), dtype=np.int64, count=num_edges
+        )
+        # a self loop counts twice towards its node's degree, as in networkx
+        self.degrees = np.bincount(src, minlength=num_nodes) + np.bincount(
+            tgt, minlength=num_nodes
+        )
+        edge_ids = np.arange(num_edges)
+        if self.directed:
+            rows, cols = src, tgt
+        else:
+            # undirected edges are stored in both rows, self loops only once
+            back = src != tgt
+            rows = np.concatenate([src, tgt[back]])
+            cols = np.concatenate([tgt, src[back]])
+            edge_ids = np.concatenate([edge_ids, edge_ids[back]])
+        order = np.lexsort((cols, rows))
+        self.indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=num_nodes), out=self.indptr[1:])
+        self.indices = cols[order]
+        self.edge_ids = edge_ids[order]
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def _lookup(self, node_ids: list[str]) -> np.ndarray:
+        """Integer ids of the given nodes, -1 for unknown ones"""
+        return np.fromiter(
+            (self.node_index.get(node_id, -1) for node_id in node_ids),
+            dtype=np.int64,
+            count=len(node_ids),
+        )
+
+    def _edge_positions(self, pairs: list[tuple[str, str]]) -> np.ndarray:
+        """Edge ids of the given (source, target) pairs, -1 for missing edges"""
+        positions = np.full(len(pairs), -1, dtype=np.int64)
+        src = self._lookup([u for u, _ in pairs])
+        tgt = self._lookup([v for _, v in pairs])
+        for i in np.flatnonzero((src >= 0) & (tgt >= 0)):
+            start, end = self.indptr[src[i]], self.indptr[src[i] + 1]
+            slot = start + np.searchsorted(self.indices[start:end], tgt[i])
+            if slot < end and self.indices[slot] == tgt[i]:
+                positions[i] = self.edge_ids[slot]
+        return positions
+
+    def _rows(self, columns: dict[str, list], positions: np.ndarray) -> list:
+        return [
+            None
+            if position < 0
+            else {
+                k: column[position]
+                for k, column in columns.items()
+                if column[position] is not None
+            }
+            for position in positions.tolist()
+        ]
+
+    def get_nodes(self, node_ids: list[str]) -> list[Union[dict, None]]:
+        return self._rows(self.node_attrs, self._lookup(node_ids))
+
+    def get_edges(self, pairs: list[tuple[str, str]]) -> list[Union[dict, None]]:
+        return self._rows(self.edge_attrs, self._edge_positions(pairs))
+
+    def node_degrees(self, node_ids: list[str]) -> np.ndarray:
+        """Degrees of the given nodes, 0 for unknown ones"""
+        positions = self._lookup(node_ids)
+        return np.where(positions >= 0, self.degrees[np.maximum(positions, 0)], 0)
+
+    def neighbors_many(self, node_ids: list[str]) -> list[Union[list[str], None]]:
+        results = []
+        for position in self._lookup(node_ids).tolist():
+            if position < 0:
+                results.append(None)
+                continue
+            start, end = self.indptr[position], self.indptr[position + 1]
+            results.append([self.nodes[j] for j in self.indices[start:end].tolist()])
+        return results
 
 
 @dataclass
@@ -130,6 +1717,86 @@ class NetworkXStorage(BaseGraphStorage):
         )
         nx.write_graphml(graph, file_name)
 
+    @staticmethod
+    def load_nx_snapshot(file_name) -> nx.Graph:
+        if not os.path.exists(file_name):
+            return None
+        with open(file_name, "rb") as f:
+            snapshot = pickle.load(f)
+        graph = nx.DiGraph() if snapshot["directed"] else nx.Graph()
+        graph.graph.update(snapshot["graph_attrs"])
+        nodes = snapshot["nodes"]
+        node_attrs = snapshot["node_attrs"]
+        graph.add_nodes_from(
+            (
+                node,
+                {
+                    k: column[i]
+                    for k, column in node_attrs.items()
+                    if column[i] is not None
+                },
+            )
+            for i, node in enumerate(nodes)
+        )
+        edge_attrs = snapshot["edge_attrs"]
+        graph.add_edges_from(
+            (
+                nodes[src],
+                nodes[tgt],
+                {
+                    k: column[i]
+                    for k, column in edge_attrs.items()
+                    if column[i] is not None
+                },
+            )
+            for i, (src, tgt) in enumerate(snapshot["edge_index"].T.tolist())
+        )
+        return graph
+
+    @staticmethod
+    def write_nx_snapshot(graph: nx.Graph, file_name):
+        """Write the graph as a pickled columnar snapshot.
+
+        Edges are an int32 (2, E) array of node positions, attributes are one
+        list per key with equal values folded onto a single object so pickle's
+        memo stores each distinct string once.
+        """
+        logger.info(
+            f"Writing graph snapshot with {graph.number_of_nodes()} nodes, {graph.number_of_edges()} edges"
+        )
+        interned = {}
+        nodes = list(graph.nodes)
+        position = {node: i for i, node in enumerate(nodes)}
+        edges = list(graph.edges(data=True))
+        snapshot = {
+            "format": 1,
+            "directed": graph.is_directed(),
+            "graph_attrs": dict(graph.graph),
+            "nodes": nodes,
+            "node_attrs": _attribute_columns(
+                [graph.nodes[node] for node in nodes], interned
+            ),
+            "edge_index": np.array(
+                [
+                    [position[src] for src, _, _ in edges],
+                    [position[tgt] for _, tgt, _ in edges],
+                ],
+                dtype=np.int32,
+            ).reshape(2, len(edges)),
+            "edge_attrs": _attribute_columns([data for _, _, data in edges], interned),
+        }
+        with open(file_name + ".tmp", "wb") as f:
+            pickle.dump(snapshot, f, protocol=5)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(file_name + ".tmp", file_name)
+        # the rename must be durable before the caller truncates the WAL
+        dir_fd = os.open(os.path.dirname(os.path.abspath(file_name)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
     @staticmethod
     def stable_largest_connected_component(graph: nx.Graph) -> nx.Graph:
         """Refer to https://github.com/microsoft/graphrag/index/graph/utils/stable_lcc.py
@@ -182,18 +1849,109 @@ class NetworkXStorage(BaseGraphStorage):
         self._graphml_xml_file = os.path.join(
             self.global_config["working_dir"], f"graph_{self.namespace}.graphml"
         )
-        preloaded_graph = NetworkXStorage.load_nx_graph(self._graphml_xml_file)
+        self._snapshot_file = os.path.join(
+            self.global_config["working_dir"], f"graph_{self.namespace}.snapshot"
+        )
+        preloaded_graph = NetworkXStorage.load_nx_snapshot(self._snapshot_file)
+        loaded_from = self._snapshot_file
+        if preloaded_graph is None:
+            preloaded_graph = NetworkXStorage.load_nx_graph(self._graphml_xml_file)
+            loaded_from = self._graphml_xml_file
+            if preloaded_graph is not None:
+                # convert the legacy GraphML file on the next flush
+                self.mark_dirty()
         if preloaded_graph is not None:
             logger.info(
-                f"Loaded graph from {self._graphml_xml_file} with {preloaded_graph.number_of_nodes()} nodes, {preloaded_graph.number_of_edges()} edges"
+                f"Loaded graph from {loaded_from} with {preloaded_graph.number_of_nodes()} nodes, {preloaded_graph.number_of_edges()} edges"
             )
         self._graph = preloaded_graph or nx.Graph()
+
+        # upserts since the last snapshot are appended to a write-ahead log and
+        # replayed on load; the log is folded into a new snapshot once replaying
+        # it would cost a sizeable fraction of loading the snapshot itself
+        storage_kwargs = self.global_config.get("graph_storage_cls_kwargs", {})
+        self._wal_checkpoint_ratio = storage_kwargs.get("wal_checkpoint_ratio", 0.5)
+        self._wal_checkpoint_min_records = storage_kwargs.get(
+            "wal_checkpoint_min_records", 10000
+        )
+        self._wal_file = os.path.join(
+            self.global_config["working_dir"], f"graph_{self.namespace}.wal"
+        )
+        self._wal_buffer: list[list] = []
+        self._wal_records = self._replay_wal()
+        self._frozen_view = None
         self._node_embed_algorithms = {
             "node2vec": self._node2vec_embed,
         }
 
+    def _apply_wal_record(self, record: list):
+        if record[0] == "node":
+            self._graph.add_node(record[1], **record[2])
+        else:
+            self._graph.add_edge(record[1], record[2], **record[3])
+
+    def _replay_wal(self) -> int:
+        if not os.path.exists(self._wal_file):
+            return 0
+        records = 0
+        offset = 0
+        with open(self._wal_file, "rb") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                self._apply_wal_record(record)
+                records += 1
+                offset += len(line)
+        if offset != os.path.getsize(self._wal_file):
+            logger.warning(f"Truncating torn tail of {self._wal_file} at byte {offset}")
+            with open(self._wal_file, "r+b") as f:
+                f.truncate(offset)
+        if records:
+            logger.info(f"Replayed {records} records from {self._wal_file}")
+        return records
+
     async def index_done_callback(self):
-        NetworkXStorage.write_nx_graph(self._graph, self._graphml_xml_file)
+        if not self.is_dirty:
+            return
+        if self._wal_buffer:
+            with open(self._wal_file, "ab") as f:
+                for record in self._wal_buffer:
+                    f.write(
+                        (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+                    )
+                f.flush()
+                os.fsync(f.fileno())
+            self._wal_records += len(self._wal_buffer)
+            self._wal_buffer = []
+        graph_size = self._graph.number_of_nodes() + self._graph.number_of_edges()
+        if not os.path.exists(self._snapshot_file) or self._wal_records >= max(
+            self._wal_checkpoint_min_records, self._wal_checkpoint_ratio * graph_size
+        ):
+            self.checkpoint()
+        self.clear_dirty()
+
+    def checkpoint(self):
+        """Write a full snapshot and start a new write-ahead log.
+        The snapshot is fsynced before the log is truncated, and replaying a
+        log already folded into the snapshot is harmless, so a crash between
+        the two steps loses nothing.
+        """
+        NetworkXStorage.write_nx_snapshot(self._graph, self._snapshot_file)
+        open(self._wal_file, "wb").close()
+        self._wal_records = 0
+
+    def export_graphml(self, file_name: str = None):
+        """Write the graph as GraphML, next to the snapshot unless a path is given"""
+        NetworkXStorage.write_nx_graph(self._graph, file_name or self._graphml_xml_file)
+
+    def frozen_view(self) -> FrozenGraphView:
+        """Array-backed copy of the graph for batched reads, rebuilt lazily
+        after the graph has changed"""
+        if self._frozen_view is None:
+            self._frozen_view = FrozenGraphView(self._graph)
+        return self._frozen_view
 
     async def has_node(self, node_id: str) -> bool:
         return self._graph.has_node(node_id)
@@ -220,13 +1978,49 @@ class NetworkXStorage(BaseGraphStorage):
             return list(self._graph.edges(source_node_id))
         return None
 
+    async def get_nodes_batch(self, node_ids: list[str]) -> list[Union[dict, None]]:
+        return self.frozen_view().get_nodes(node_ids)
+
+    async def node_degrees_batch(self, node_ids: list[str]) -> list[int]:
+        return self.frozen_view().node_degrees(node_ids).tolist()
+
+    async def get_edges_batch(
+        self, pairs: list[tuple[str, str]]
+    ) -> list[Union[dict, None]]:
+        return self.frozen_view().get_edges(pairs)
+
+    async def edge_degrees_batch(self, pairs: list[tuple[str, str]]) -> list[int]:
+        view = self.frozen_view()
+        degrees = view.node_degrees([s for s, _ in pairs]) + view.node_degrees(
+            [t for _, t in pairs]
+        )
+        return degrees.tolist()
+
+    async def get_nodes_edges_batch(
+        self, node_ids: list[str]
+    ) -> list[Union[list[tuple[str, str]], None]]:
+        return [
+            None if neighbors is None else [(node_id, n) for n in neighbors]
+            for node_id, neighbors in zip(
+                node_ids, self.frozen_view().neighbors_many(node_ids)
+            )
+        ]
+
     async def upsert_node(self, node_id: str, node_data: dict[str, str]):
         self._graph.add_node(node_id, **node_data)
+        self._wal_buffer.append(["node", node_id, dict(node_data)])
+        self._frozen_view = None
+        self.mark_dirty()
 
     async def upsert_edge(
         self, source_node_id: str, target_node_id: str, edge_data: dict[str, str]
     ):
         self._graph.add_edge(source_node_id, target_node_id, **edge_data)
+        self._wal_buffer.append(
+            ["edge", source_node_id, target_node_id, dict(edge_data)]
+        )
+        self._frozen_view = None
+        self.mark_dirty()
 
     async def embed_nodes(self, algorithm: str) -> tuple[np.ndarray, list[str]]:
         if algorithm not in self._node_embed_algorithms:
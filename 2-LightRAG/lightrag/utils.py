@@ -6,8 +6,11 @@ import json
 import logging
 import os
 import re
+import time
+from collections import deque
+from contextvars import ContextVar
 from dataclasses import dataclass
-from functools import wraps
+from functools import lru_cache, wraps
 from hashlib import md5
 from typing import Any, Union,List
 import xml.etree.ElementTree as ET
@@ -15,8 +18,6 @@ import xml.etree.ElementTree as ET
 import numpy as np
 import tiktoken
 
-ENCODER = None
-
 logger = logging.getLogger("lightrag")
 
 
@@ -73,23 +74,301 @@ def compute_mdhash_id(content, prefix: str = ""):
     return prefix + md5(content.encode()).hexdigest()
 
 
-def limit_async_func_call(max_size: int, waitting_time: float = 0.0001):
-    """Add restriction of maximum async calling times for a async func"""
+class TokenBucket:
+    """Budget of ``per_minute`` units refilled continuously"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self._tokens = float(per_minute)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    async def take(self, amount: int):
+        # a single request larger than the whole budget waits for a full bucket
+        amount = min(amount, self.capacity)
+        while True:
+            self._refill()
+            if self._tokens >= amount:
+                self._tokens -= amount
+                return
+            await asyncio.sleep((amount - self._tokens) / self.rate)
+
+
+class AsyncLimiter:
+    """FIFO concurrency limiter with optional per-minute budgets.
+
+    At most ``limit`` holders run at once. Waiters are served by ascending
+    ``priority`` and in arrival order within a priority; a released slot is
+    handed straight to the next waiter. Futures are created on the running
+    loop at wait time, so the limiter is not tied to the loop it was created
+    on. ``max_requests_per_minute`` and ``max_tokens_per_minute`` are token
+    buckets drawn from once a slot is held.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_requests_per_minute: int = None,
+        max_tokens_per_minute: int = None,
+    ):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self._active = 0
+        self._waiters: dict[int, deque[asyncio.Future]] = {}
+        self._requests = (
+            TokenBucket(max_requests_per_minute) if max_requests_per_minute else None
+        )
+        self._tokens = (
+            TokenBucket(max_tokens_per_minute) if max_tokens_per_minute else None
+        )
+        self.calls = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.completed = 0
+        self.completed_tokens = 0
+        self._started: float = None
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    @property
+    def counts_tokens(self) -> bool:
+        return self._tokens is not None
+
+    @property
+    def tokens_per_second(self) -> float:
+        if self._started is None:
+            return 0.0
+        elapsed = time.monotonic() - self._started
+        return self.completed_tokens / elapsed if elapsed > 0 else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "active": self._active,
+            "queue_depth": self.queue_depth,
+            "calls": self.calls,
+            "avg_wait": self.total_wait / self.calls if self.calls else 0.0,
+            "max_wait": self.max_wait,
+            "completed": self.completed,
+            "tokens_per_second": self.tokens_per_second,
+        }
+
+    def _next_waiter(self) -> Union[asyncio.Future, None]:
+        for priority in sorted(self._waiters):
+            waiters = self._waiters[priority]
+            while waiters:
+                waiter = waiters.popleft()
+                if not waiter.done():
+                    return waiter
+        return None
+
+    def _wake(self):
+        """Hand out the slots freed by a raised limit"""
+        while self._active < self.limit:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            self._active += 1
+            waiter.set_result(None)
+
+    async def _acquire_slot(self, priority: int):
+        if self._active < self.limit and not self.queue_depth:
+            self._active += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(priority, deque()).append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # the slot was handed over as we got cancelled, pass it on
+                self.release()
+            elif waiter in self._waiters[priority]:
+                # _next_waiter may already have skipped and dropped it
+                self._waiters[priority].remove(waiter)
+            raise
+
+    async def acquire(self, tokens: int = 0, priority: int = 0):
+        start = time.monotonic()
+        await self._acquire_slot(priority)
+        try:
+            if self._requests is not None:
+                await self._requests.take(1)
+            if self._tokens is not None and tokens:
+                await self._tokens.take(tokens)
+        except BaseException:
+            self.release()
+            raise
+        waited = time.monotonic() - start
+        self.calls += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        if self._started is None:
+            self._started = time.monotonic()
+
+    def release(self):
+        # a lowered limit is enforced by not handing the slot on
+        if self._active <= self.limit:
+            waiter = self._next_waiter()
+            if waiter is not None:
+                waiter.set_result(None)
+                return
+        self._active -= 1
+
+    def on_success(self, tokens: int = 0):
+        self.completed += 1
+        self.completed_tokens += tokens
+
+
+class AdaptiveLimiter(AsyncLimiter):
+    """AsyncLimiter whose concurrency follows the provider's throttling.
+
+    Every completed call raises the limit by ``1 / limit`` (about one slot per
+    round of calls) up to ``max_concurrency``; a reported rate limit halves it,
+    at most once per ``decrease_cooldown`` seconds so a burst of 429s from the
+    calls already in flight counts once. A ``retry_after`` hint also holds
+    back every new call until it expires, instead of letting each retry find
+    out on its own.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int,
+        max_requests_per_minute: int = None,
+        max_tokens_per_minute: int = None,
+        min_concurrency: int = 1,
+        decrease_factor: float = 0.5,
+        decrease_cooldown: float = 1.0,
+    ):
+        super().__init__(
+            max_concurrency, max_requests_per_minute, max_tokens_per_minute
+        )
+        self.min_concurrency = min_concurrency
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self._window = float(max_concurrency)
+        self._last_decrease = float("-inf")
+        self._resume_at = 0.0
+        self.rate_limited = 0
+
+    def stats(self) -> dict:
+        return {**super().stats(), "rate_limited": self.rate_limited}
+
+    async def acquire(self, tokens: int = 0, priority: int = 0):
+        await super().acquire(tokens, priority)
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except BaseException:
+                self.release()
+                raise
+
+    def on_success(self, tokens: int = 0):
+        super().on_success(tokens)
+        self._window = min(self.max_concurrency, self._window + 1 / self._window)
+        self.limit = max(self.min_concurrency, int(self._window))
+        self._wake()
+
+    def on_rate_limited(self, retry_after: float = None):
+        self.rate_limited += 1
+        now = time.monotonic()
+        if retry_after:
+            self._resume_at = max(self._resume_at, now + retry_after)
+        if now - self._last_decrease < self.decrease_cooldown:
+            return
+        self._last_decrease = now
+        self._window = max(self.min_concurrency, self._window * self.decrease_factor)
+        self.limit = max(self.min_concurrency, int(self._window))
+        logger.info(
+            f"Rate limited, lowering concurrency to {self.limit} (retry after {retry_after}s)"
+        )
+
+
+_current_limiter: ContextVar[Union[AsyncLimiter, None]] = ContextVar(
+    "lightrag_current_limiter", default=None
+)
+
+
+def report_rate_limit(retry_after: float = None):
+    """Tell the adaptive limiter running the current call that the provider
+    throttled it, e.g. from a retry hook"""
+    limiter = _current_limiter.get()
+    if isinstance(limiter, AdaptiveLimiter):
+        limiter.on_rate_limited(retry_after)
+
+
+def count_call_tokens(*args, tiktoken_model_name: str = "gpt-4o", **kwargs) -> int:
+    """Rough prompt size of an LLM or embedding call: the tiktoken length of
+    every string, list of strings and list of chat messages passed to it"""
+    strings = []
+    for value in list(args) + list(kwargs.values()):
+        if isinstance(value, str):
+            strings.append(value)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                if isinstance(item, str):
+                    strings.append(item)
+                elif isinstance(item, dict) and isinstance(item.get("content"), str):
+                    strings.append(item["content"])
+    return sum(
+        len(encode_string_by_tiktoken(string, tiktoken_model_name))
+        for string in strings
+    )
+
+
+def limit_async_func_call(
+    max_size: int,
+    max_requests_per_minute: int = None,
+    max_tokens_per_minute: int = None,
+    adaptive: bool = False,
+    tiktoken_model_name: str = "gpt-4o",
+):
+    """Add restriction of maximum async calling times for a async func.
+    Calls may pass a ``priority`` keyword (lower runs first, default 0), which
+    is consumed here. The wrapper exposes its limiter as ``.limiter``.
+    Prompts and results are only counted, with the ``tiktoken_model_name``
+    encoder, when ``max_tokens_per_minute`` is set."""
 
     def final_decro(func):
-        """Not using async.Semaphore to aovid use nest-asyncio"""
-        __current_size = 0
+        limiter_cls = AdaptiveLimiter if adaptive else AsyncLimiter
+        limiter = limiter_cls(max_size, max_requests_per_minute, max_tokens_per_minute)
 
         @wraps(func)
-        async def wait_func(*args, **kwargs):
-            nonlocal __current_size
-            while __current_size >= max_size:
-                await asyncio.sleep(waitting_time)
-            __current_size += 1
-            result = await func(*args, **kwargs)
-            __current_size -= 1
+        async def wait_func(*args, priority: int = 0, **kwargs):
+            tokens = (
+                count_call_tokens(
+                    *args, tiktoken_model_name=tiktoken_model_name, **kwargs
+                )
+                if limiter.counts_tokens
+                else 0
+            )
+            await limiter.acquire(tokens, priority=priority)
+            token = _current_limiter.set(limiter)
+            try:
+                result = await func(*args, **kwargs)
+            finally:
+                _current_limiter.reset(token)
+                limiter.release()
+            if limiter.counts_tokens and isinstance(result, str):
+                tokens += len(encode_string_by_tiktoken(result, tiktoken_model_name))
+            limiter.on_success(tokens)
             return result
 
+        wait_func.limiter = limiter
         return wait_func
 
     return final_decro
@@ -117,22 +396,37 @@ def write_json(json_obj, file_name):
         json.dump(json_obj, f, indent=2, ensure_ascii=False)
 
 
+@lru_cache(maxsize=None)
+def get_tiktoken_encoder(model_name: str = "gpt-4o") -> tiktoken.Encoding:
+    """the encoder of a model, built once per process"""
+    return tiktoken.encoding_for_model(model_name)
+
+
 def encode_string_by_tiktoken(content: str, model_name: str = "gpt-4o"):
-    global ENCODER
-    if ENCODER is None:
-        ENCODER = tiktoken.encoding_for_model(model_name)
-    tokens = ENCODER.encode(content)
+    tokens = get_tiktoken_encoder(model_name).encode(content)
     return tokens
 
 
 def decode_tokens_by_tiktoken(tokens: list[int], model_name: str = "gpt-4o"):
-    global ENCODER
-    if ENCODER is None:
-        ENCODER = tiktoken.encoding_for_model(model_name)
-    content = ENCODER.decode(tokens)
+    content = get_tiktoken_encoder(model_name).decode(tokens)
     return content
 
 
+def encode_strings_by_tiktoken(
+    contents: list[str], model_name: str = "gpt-4o", num_threads: int = 8
+) -> list[list[int]]:
+    """encode several strings at once, tiktoken spreads them over threads"""
+    return get_tiktoken_encoder(model_name).encode_batch(
+        contents, num_threads=num_threads
+    )
+
+
+def decode_tokens_batch_by_tiktoken(
+    batch: list[list[int]], model_name: str = "gpt-4o", num_threads: int = 8
+) -> list[str]:
+    return get_tiktoken_encoder(model_name).decode_batch(batch, num_threads=num_threads)
+
+
 def pack_user_ass_to_openai_messages(*args: str):
     roles = ["user", "assistant"]
     return [